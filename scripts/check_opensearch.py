@@ -14,6 +14,9 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
+# checks packed in one _msearch request of a batch
+MSEARCH_SIZE = 100
+
 def parse_opts():
     """Help messages(-h, --help)."""
 
@@ -29,53 +32,78 @@ def parse_opts():
           {0} -n opensearch.heylinux.com -a username:password -d app_name:foo,case:bar -o severity -v
           {0} -n opensearch.heylinux.com -a username:password -d app_name:foo,case:bar -o summary
           {0} -n opensearch.heylinux.com -a username:password -d app_name:foo,case:bar -o severity -m 15
+          {0} -n opensearch.heylinux.com -a username:password -f /etc/zabbix/opensearch_checks.jsonl | zabbix_sender -c /etc/zabbix/zabbix_agentd.conf -i -
+
+          /etc/zabbix/opensearch_checks.jsonl, one check per line, keys as the metavars of the flags: data, output and minute,
+          key and host of the zabbix_sender line:
+          {{"data": "app_name:foo,case:bar", "output": "severity"}}
+          {{"data": "app_name:foo,case:bar", "output": "summary", "minute": 15, "key": "foo.bar.summary"}}
         '''.format(__file__)
         ))
 
     parser.add_argument('-n', metavar='domain', type=str, required=True, help='OpenSearch domain')
     parser.add_argument('-a', metavar='auth', type=str, required=True, help='username:password for basic authentication')
-    parser.add_argument('-d', metavar='data', type=str, required=True, help='key1:value1,key2:value2 to search')
-    parser.add_argument('-o', metavar='output', type=str, choices=['severity','summary'], required=True, help='display value of the key in output')
+    parser.add_argument('-d', metavar='data', type=str, help='key1:value1,key2:value2 to search')
+    parser.add_argument('-o', metavar='output', type=str, choices=['severity','summary'], help='display value of the key in output')
     parser.add_argument('-m', metavar='minute', type=int, help='period to search [default: 1440]')
     parser.add_argument('-v', action="store_true", default=False, help='debug with json body')
+    parser.add_argument('-f', metavar='batch', type=str, help='file of JSON checks, one per line, to run in _msearch requests, - for stdin')
+    parser.add_argument('-H', metavar='host', type=str, default='-', help='host name in the zabbix_sender lines of batch mode [default: -, the agent hostname]')
 
     if len(sys.argv) < 2:
         parser.print_help()
         sys.exit(2)
 
     args = parser.parse_args()
-    return {'domain':args.n, 'auth':args.a, 'data':args.d, 'output':args.o, 'minute':args.m, 'debug':args.v}
 
-def get_results(opts):
-    """Get results with given parameters."""
+    if not args.f and not (args.d and args.o):
+        print("Either -d data and -o output, or -f batch is required")
+        sys.exit(2)
 
-    url = "https://{0}/index-name-*/_search".format(opts['domain'])
+    return {'domain':args.n, 'auth':args.a, 'data':args.d, 'output':args.o, 'minute':args.m, 'debug':args.v,
+            'batch':args.f, 'host':args.H}
 
-    username = opts['auth'].split(':')[0]
-    password = opts['auth'].split(':')[1]
-    httpauth = HTTPBasicAuth(username, password)
+def build_query(opts):
+    """Build the search body with given parameters."""
 
+    # rounded to the minute, so the same check gives the same query for a minute and hits the caches
     if opts['minute']:
-      gte_str = "now-{0}m".format(opts['minute'])
+      gte_str = "now-{0}m/m".format(opts['minute'])
     else:
       # search in 1440 minutes by default
-      gte_str = "now-1440m"
+      gte_str = "now-1440m/m"
 
     k1 = opts['data'].split(',')[0].split(':')[0]
     v1 = opts['data'].split(',')[0].split(':')[1]
     k2 = opts['data'].split(',')[1].split(':')[0]
     v2 = opts['data'].split(',')[1].split(':')[1]
 
+    # filter context is not scored and its clauses can be cached by the node query cache,
+    # lt now+1m/m still includes the current minute
     data = {"size":1,
             "sort":{"publish_time":"desc"},
             "query":{
               "bool":{
-                "must":[
-                  {"range":{"publish_time":{"gte":gte_str,"lt":"now"}}},
+                "filter":[
+                  {"range":{"publish_time":{"gte":gte_str,"lt":"now+1m/m"}}},
                   {"match":{k1:v1}},
                   {"match":{k2:v2}}
                 ]}}}
 
+    return data
+
+def get_results(opts):
+    """Get results with given parameters."""
+
+    # the shard request cache skips requests with hits unless asked for
+    url = "https://{0}/index-name-*/_search?request_cache=true".format(opts['domain'])
+
+    username = opts['auth'].split(':')[0]
+    password = opts['auth'].split(':')[1]
+    httpauth = HTTPBasicAuth(username, password)
+
+    data = build_query(opts)
+
     headers = {"Content-Type": "application/json; charset=utf-8"}
 
     try:
@@ -124,9 +152,121 @@ def get_results(opts):
 
     return True
 
+def zabbix_quote(value):
+    """Quote a value for zabbix_sender input, which reads one item per line."""
+
+    value = str(value)
+    if value and not any(c in value for c in ' \t\n"\\'):
+        return value
+    value = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '"{0}"'.format(value)
+
+def load_checks(batch):
+    """Load the checks of a batch file, one JSON object per line."""
+
+    if batch == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(batch) as f:
+            lines = f.readlines()
+
+    checks = []
+    for line_number,line in enumerate(lines,1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            check = json.loads(line)
+        except ValueError as e:
+            print("Invalid check on line {0} of {1}: {2}".format(line_number,batch,str(e)))
+            sys.exit(2)
+        kv_items = str(check.get('data','')).split(',')
+        if len(kv_items) != 2 or any(':' not in kv_item for kv_item in kv_items) or check.get('output') not in ['severity','summary']:
+            print("Invalid check on line {0} of {1}. Expected data key1:value1,key2:value2 and output severity or summary".format(line_number,batch))
+            sys.exit(2)
+        check.setdefault('minute',None)
+        checks.append(check)
+
+    return checks
+
+def get_check_output(check,response):
+    """Get the output of one check from its response in _msearch, as get_results prints it."""
+
+    if "error" in response:
+        if check['output'] == "severity":
+            return 5
+        return "StatusCode: {0}, Error: {1}".format(response.get("status"),json.dumps(response["error"]))
+    try:
+        return response["hits"]["hits"][0]["_source"][check['output']]
+    except KeyError:
+        return 5 if check['output'] == "severity" else "Exception: KeyError"
+    except IndexError:
+        return 5 if check['output'] == "severity" else "Exception: IndexError"
+
+def get_batch_results(opts):
+    """Run the checks of a batch file in _msearch requests and print one zabbix_sender line per check."""
+
+    url = "https://{0}/_msearch".format(opts['domain'])
+
+    username = opts['auth'].split(':')[0]
+    password = opts['auth'].split(':')[1]
+    httpauth = HTTPBasicAuth(username, password)
+
+    headers = {"Content-Type": "application/x-ndjson; charset=utf-8"}
+
+    checks = load_checks(opts['batch'])
+
+    # one session, so the requests of all the chunks share one connection
+    session = requests.Session()
+    for i in range(0,len(checks),MSEARCH_SIZE):
+        chunk = checks[i:i + MSEARCH_SIZE]
+        lines = []
+        for check in chunk:
+            lines.append(json.dumps({"index":"index-name-*", "request_cache":True}))
+            lines.append(json.dumps(build_query(check)))
+        body = '\n'.join(lines) + '\n'
+
+        # an _msearch that fails as a whole fails every check of it the way get_results would
+        failure = None
+        try:
+            res = session.post(url, headers=headers, auth=httpauth, data=body.encode('utf-8'), verify=False, timeout=5 + len(chunk) // 10)
+            if res.status_code == requests.codes.ok:
+                responses = res.json()["responses"]
+                if len(responses) != len(chunk):
+                    failure = "Exception: IndexError"
+            else:
+                failure = "StatusCode: {0}, Error: {1}".format(res.status_code,res.content)
+        except requests.exceptions.Timeout:
+            failure = "Exception: Timeout"
+        except requests.exceptions.ConnectionError:
+            failure = "Exception: ConnectionError"
+        except ValueError:
+            # a 200 reply that is not JSON, e.g. from a proxy
+            failure = "Exception: ValueError"
+        except (KeyError,TypeError):
+            # a JSON reply without responses
+            failure = "Exception: KeyError"
+
+        for j,check in enumerate(chunk):
+            if failure:
+                response = {}
+                output = 5 if check['output'] == "severity" else failure
+            else:
+                response = responses[j]
+                output = get_check_output(check,response)
+            key = check.get('key') or "check_opensearch[{0},{1}]".format(check['data'],check['output'])
+            print("{0} {1} {2}".format(zabbix_quote(check.get('host') or opts['host']),zabbix_quote(key),zabbix_quote(output)))
+            if opts['debug']:
+                print(json.dumps(response,indent=2))
+
+    return True
+
 def main():
     opts = parse_opts()
-    get_results(opts)
+    if opts['batch']:
+        get_batch_results(opts)
+    else:
+        get_results(opts)
 
     return 0
 
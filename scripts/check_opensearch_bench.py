@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+# Description: Benchmark the cache eligibility of the queries of check_opensearch.py against a local stand-in for OpenSearch
+
+import re
+import sys
+import json
+import time
+import random
+import threading
+
+import requests
+
+import check_opensearch
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+DATE_MATH_RE = re.compile(r'^now((?:[+-]\d+[smhd])*)(?:/([smhd]))?$')
+UNIT_MS = {'s':1000, 'm':60000, 'h':3600000, 'd':86400000}
+
+def parse_opts():
+    """Help messages(-h, --help)."""
+
+    import textwrap
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent(
+        '''
+        examples:
+          {0}
+          {0} --checks 100 --agents 3 --minutes 30
+          {0} --save opensearch_cache.json
+        '''.format(__file__)
+        ))
+
+    parser.add_argument('--checks', type=int, default=20, help='distinct checks, each run by every agent once a minute [default: 20]')
+    parser.add_argument('--agents', type=int, default=2, help='agents running the same checks [default: 2]')
+    parser.add_argument('--minutes', type=int, default=10, help='simulated minutes [default: 10]')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the offsets of the checks in each minute [default: 1]')
+    parser.add_argument('--save', type=str, help='save the results as JSON to this file')
+
+    args = parser.parse_args()
+
+    return {'checks':args.checks, 'agents':args.agents, 'minutes':args.minutes, 'seed':args.seed, 'save':args.save}
+
+def old_build_query(opts):
+    """The previous query: scored must clauses and a range up to the current millisecond."""
+
+    if opts['minute']:
+      gte_str = "now-{0}m".format(opts['minute'])
+    else:
+      gte_str = "now-1440m"
+
+    k1 = opts['data'].split(',')[0].split(':')[0]
+    v1 = opts['data'].split(',')[0].split(':')[1]
+    k2 = opts['data'].split(',')[1].split(':')[0]
+    v2 = opts['data'].split(',')[1].split(':')[1]
+
+    return {"size":1,
+            "sort":{"publish_time":"desc"},
+            "query":{
+              "bool":{
+                "must":[
+                  {"range":{"publish_time":{"gte":gte_str,"lt":"now"}}},
+                  {"match":{k1:v1}},
+                  {"match":{k2:v2}}
+                ]}}}
+
+def resolve_now(value,now_ms):
+    """Resolve date math on now at the given epoch milliseconds, and whether it is rounded."""
+
+    match = DATE_MATH_RE.match(value)
+    if not match:
+        return value,True
+    resolved = now_ms
+    for sign,amount,unit in re.findall(r'([+-])(\d+)([smhd])',match.group(1)):
+        resolved = resolved + int(sign + amount) * UNIT_MS[unit]
+    if match.group(2):
+        resolved = resolved - resolved % UNIT_MS[match.group(2)]
+    return resolved,match.group(2) is not None
+
+def resolve_body(body,now_ms):
+    """Resolve every now in a search body, and whether all of them are rounded."""
+
+    rounded = [True]
+
+    def resolve(node):
+        if isinstance(node,dict):
+            return dict((k,resolve(v)) for k,v in node.items())
+        if isinstance(node,list):
+            return [resolve(v) for v in node]
+        if isinstance(node,str) and node.startswith('now'):
+            resolved,is_rounded = resolve_now(node,now_ms)
+            rounded[0] = rounded[0] and is_rounded
+            return resolved
+        return node
+
+    return resolve(body),rounded[0]
+
+class StandIn(object):
+    """Counts the searches the shard request cache and the node query cache could answer.
+
+    Like OpenSearch, a search is only eligible for the request cache with size 0
+    or request_cache=true, and not when it uses now without rounding, since its
+    resolved value changes every millisecond. Only clauses in filter context go
+    to the query cache. A hit is a resolved request or clause seen before.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.request_cache_eligible = 0
+        self.request_cache_hits = 0
+        self.clauses = 0
+        self.query_cache_eligible = 0
+        self.query_cache_hits = 0
+        self.request_cache = set()
+        self.query_cache = set()
+
+    def search(self,body,request_cache,now_ms):
+        resolved,rounded = resolve_body(body,now_ms)
+        with self.lock:
+            self.requests = self.requests + 1
+            if (body.get("size",10) == 0 or request_cache) and rounded:
+                self.request_cache_eligible = self.request_cache_eligible + 1
+                key = json.dumps(resolved,sort_keys=True)
+                if key in self.request_cache:
+                    self.request_cache_hits = self.request_cache_hits + 1
+                self.request_cache.add(key)
+
+            query_bool = body["query"]["bool"]
+            resolved_bool = resolved["query"]["bool"]
+            for context in ["must","should","filter","must_not"]:
+                for clause,resolved_clause in zip(query_bool.get(context,[]),resolved_bool.get(context,[])):
+                    self.clauses = self.clauses + 1
+                    if context not in ["filter","must_not"] or not resolve_body(clause,now_ms)[1]:
+                        continue
+                    self.query_cache_eligible = self.query_cache_eligible + 1
+                    key = json.dumps(resolved_clause,sort_keys=True)
+                    if key in self.query_cache:
+                        self.query_cache_hits = self.query_cache_hits + 1
+                    self.query_cache.add(key)
+
+def make_handler(stand_in):
+    class SearchHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            parts = urlsplit(self.path)
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+            request_cache = parse_qs(parts.query).get('request_cache') == ['true']
+            stand_in.search(body,request_cache,int(self.headers['X-Bench-Now']))
+
+            data = json.dumps({"hits":{"total":{"value":1},"hits":[{"_source":{"severity":3,"summary":"bench"}}]}}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type','application/json')
+            self.send_header('Content-Length',str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self,*args):
+            pass
+
+    return SearchHandler
+
+def get_schedule(opts):
+    """Get the simulated epoch milliseconds and check of every search, in time order."""
+
+    random.seed(opts['seed'])
+    start_ms = 1792281600000
+    schedule = []
+    for minute in range(opts['minutes']):
+        for agent in range(opts['agents']):
+            for check in range(opts['checks']):
+                schedule.append((start_ms + minute * 60000 + random.randint(0,59999),check))
+    schedule.sort()
+    return schedule
+
+def main():
+    opts = parse_opts()
+
+    stand_in = StandIn()
+    server = HTTPServer(('127.0.0.1',0),make_handler(stand_in))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:{0}/index-name-*/_search".format(server.server_port)
+
+    checks = [{'data':"app_name:app{0},case:case{1}".format(i,i % 5), 'minute':[None,15,60][i % 3], 'output':'severity'}
+              for i in range(opts['checks'])]
+    # the same URL parameters as get_results of each version
+    builders = [('old must, now',old_build_query,url),
+                ('new filter, now/m',check_opensearch.build_query,url + "?request_cache=true")]
+
+    session = requests.Session()
+    results = []
+    for name,build_query,search_url in builders:
+        stand_in.reset()
+        start_timestamp = time.time()
+        for now_ms,check in get_schedule(opts):
+            res = session.post(search_url, headers={"Content-Type":"application/json; charset=utf-8", "X-Bench-Now":str(now_ms)},
+                               json=build_query(checks[check]), timeout=5)
+            res.raise_for_status()
+        secs = time.time() - start_timestamp
+
+        result = {'name':name, 'requests':stand_in.requests, 'request_cache_eligible':stand_in.request_cache_eligible,
+                  'request_cache_hits':stand_in.request_cache_hits, 'clauses':stand_in.clauses,
+                  'query_cache_eligible':stand_in.query_cache_eligible, 'query_cache_hits':stand_in.query_cache_hits, 'secs':secs}
+        results.append(result)
+        print("  {0:<20} {1:>6} requests  request cache eligible {2:>6} hits {3:>6}  query cache eligible {4:>6}/{5:<6} clauses hits {6:>6}".format(
+            name,result['requests'],result['request_cache_eligible'],result['request_cache_hits'],
+            result['query_cache_eligible'],result['clauses'],result['query_cache_hits']))
+
+    server.shutdown()
+
+    if opts['save']:
+        data = {'date':time.strftime('%Y-%m-%d %H:%M:%S'), 'python':sys.version.split()[0], 'checks':opts['checks'],
+                'agents':opts['agents'], 'minutes':opts['minutes'], 'results':results}
+        with open(opts['save'],'w') as f:
+            json.dump(data,f,indent=2,sort_keys=True)
+        print("Saved results to {0}".format(opts['save']))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
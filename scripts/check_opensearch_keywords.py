@@ -4,7 +4,10 @@
 # Description: HTTPS requests check key words from index-name-* for OpenSearch
 # Author: Damon Guo
 
+import os
 import sys
+import time
+import sqlite3
 import requests
 from requests.auth import HTTPBasicAuth
 import json
@@ -14,6 +17,20 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
+# values of -g with the most lines to count
+TERMS_SIZE = 20
+# hits per page of an export, and how long the point in time is kept between pages
+PAGE_SIZE = 1000
+PIT_KEEP_ALIVE = "5m"
+# checks packed in one _msearch request of a batch
+MSEARCH_SIZE = 100
+# the last searched time and the per minute counts of each incremental check
+STATE_DB = '/var/tmp/opensearch_keywords_state.db'
+# lines indexed this late after their @timestamp are still counted by the next incremental search
+INGEST_LAG_MS = 30000
+# lines printed per run of an incremental check, the newest ones, the rest are only counted
+INCREMENTAL_SIZE = 10
+
 def parse_opts():
     """Help messages(-h, --help)."""
 
@@ -34,34 +51,67 @@ def parse_opts():
               -d "kubernetes.pod.name:*job*,message:*error*" -m 240 -w
           {0} -n opensearch.heylinux.com -a username:password -i "logstash-eks-containers-log-*" \
               -d "kubernetes.pod.name:*job*,message:*error*" -m 240 -w -c
+          {0} -n opensearch.heylinux.com -a username:password -i "logstash-eks-containers-log-*" \
+              -d "kubernetes.pod.name:*job*,message:*error*" -m 240 -w -c -g kubernetes.pod.name -b 1h
+          {0} -n opensearch.heylinux.com -a username:password -i "logstash-eks-containers-log-*" \
+              -d "kubernetes.pod.name:*job*,message:*error*" -m 240 -w -e /tmp/job_errors.ndjson
+          {0} -n opensearch.heylinux.com -a username:password -i "logstash-eks-containers-log-*" \
+              -d kubernetes.container.name:"app-auth",message:"LOGIN_ERROR LinuxPlatform" -m 1440 -c -r
+          {0} -n opensearch.heylinux.com -a username:password -i "logstash-eks-containers-log-*" \
+              -f /etc/zabbix/opensearch_keywords_checks.jsonl | zabbix_sender -c /etc/zabbix/zabbix_agentd.conf -i -
+
+          /etc/zabbix/opensearch_keywords_checks.jsonl, one check per line, keys as the metavars of the flags: data, index,
+          output and minute, wildcard for -w and count for -c as true, key and host of the zabbix_sender line.
+          The index, output and minute of the command line by default, the count or else the latest output as value:
+          {{"data": "kubernetes.container.name:app-auth,message:LOGIN_ERROR LinuxPlatform", "count": true}}
+          {{"data": "kubernetes.pod.name:*job*,message:*error*", "wildcard": true, "minute": 240, "key": "job.errors"}}
         '''.format(__file__)
         ))
 
     parser.add_argument('-n', metavar='domain', type=str, required=True, help='OpenSearch domain')
     parser.add_argument('-a', metavar='auth', type=str, required=True, help='username:password for basic authentication')
     parser.add_argument('-i', metavar='index', type=str, required=True, help='index to search')
-    parser.add_argument('-d', metavar='data', type=str, required=True, help='key1:value1,key2:value2,... to search')
+    parser.add_argument('-d', metavar='data', type=str, help='key1:value1,key2:value2,... to search')
     parser.add_argument('-o', metavar='output', type=str, default='message', help='display value of the key in output [default: message]')
     parser.add_argument('-m', metavar='minute', type=int, default=1440, help='period to search [default: 1440]')
     parser.add_argument('-w', action="store_true", default=False, help='wildcard search')
     parser.add_argument('-v', action="store_true", default=False, help='debug with json body')
     parser.add_argument('-c', action="store_true", default=False, help='count the lines of output')
+    parser.add_argument('-r', action="store_true", default=False, help='incremental, search only the lines after the last run of the same check and keep the count of the period locally, without -c print the newest 10 new lines and the count of the others')
+    parser.add_argument('-e', metavar='export', type=str, help='write every line of the period as NDJSON of the output key to this file, - for stdout, an interrupted export resumes')
+    parser.add_argument('-f', metavar='batch', type=str, help='file of JSON checks, one per line, to run in _msearch requests, - for stdin')
+    parser.add_argument('-H', metavar='host', type=str, default='-', help='host name in the zabbix_sender lines of batch mode [default: -, the agent hostname]')
+    parser.add_argument('-g', metavar='group', type=str, help='with -c, also count the lines by the values of the key')
+    parser.add_argument('-b', metavar='bucket', type=str, help='with -c, also count the lines by time buckets of this interval, e.g. 10m, 1h')
 
     if len(sys.argv) < 2:
         parser.print_help()
         sys.exit(2)
 
     args = parser.parse_args()
-    return {'domain':args.n, 'auth':args.a, 'index':args.i, 'data':args.d, 'output':args.o, 'minute':args.m, 'wildcard':args.w, 'debug':args.v, 'count':args.c}
 
-def get_results(opts):
-    """Get results with given parameters."""
+    if not args.d and not args.f:
+        print("Either -d data or -f batch is required")
+        sys.exit(2)
 
-    url = "https://{0}/{1}/_search".format(opts['domain'],opts['index'])
+    if (args.g or args.b) and not args.c:
+        print("-g group and -b bucket require -c")
+        sys.exit(2)
 
-    username = opts['auth'].split(':')[0]
-    password = opts['auth'].split(':')[1]
-    httpauth = HTTPBasicAuth(username, password)
+    if args.r and (args.e or args.f or args.g or args.b):
+        print("-r incremental can not be used with -e export, -f batch, -g group or -b bucket")
+        sys.exit(2)
+
+    if args.e and args.c:
+        print("-e export and -c count are exclusive")
+        sys.exit(2)
+
+    return {'domain':args.n, 'auth':args.a, 'index':args.i, 'data':args.d, 'output':args.o, 'minute':args.m, 'wildcard':args.w, 'debug':args.v, 'count':args.c,
+            'group':args.g, 'bucket':args.b, 'export':args.e, 'batch':args.f, 'host':args.H,
+            'incremental':args.r}
+
+def build_query(opts,gte=None,lt=None):
+    """Build the search body with given parameters, over the period or between gte and lt epoch milliseconds."""
 
     gte_str = "now-{0}m".format(opts['minute'])
 
@@ -85,22 +135,133 @@ def get_results(opts):
             match_item = {"match":{k:{"query":v,"operator":"and"}}}
         data["query"]["bool"]["must"].append(match_item)
 
+    if gte is not None:
+        data["query"]["bool"]["must"][0] = {"range":{"@timestamp":{"gte":gte,"lt":lt,"format":"epoch_millis"}}}
+
+    if opts['count']:
+        # count on the server rather than the first page of hits, exact past 10000 and without transferring any documents
+        del data["sort"]
+        data["size"] = 0
+        data["track_total_hits"] = True
+        aggs = {}
+        if opts['group']:
+            aggs["group"] = {"terms":{"field":opts['group'],"size":TERMS_SIZE}}
+        if opts['bucket']:
+            aggs["bucket"] = {"date_histogram":{"field":"@timestamp","fixed_interval":opts['bucket'],"min_doc_count":0}}
+        if aggs:
+            data["aggs"] = aggs
+
+    return data
+
+def open_state_db():
+    """Open the state of the incremental checks, shared by concurrent runs."""
+
+    conn = sqlite3.connect(STATE_DB,timeout=30)
+    conn.execute("CREATE TABLE IF NOT EXISTS checks (key TEXT PRIMARY KEY, last_ms INTEGER, buckets TEXT)")
+    return conn
+
+def get_check_key(opts):
+    """Get the key of a check definition in the state."""
+
+    return json.dumps([opts['domain'],opts['index'],opts['data'],opts['wildcard'],opts['minute'],opts['count']])
+
+def load_check_state(opts):
+    """Load the last searched epoch milliseconds of a check."""
+
+    conn = open_state_db()
+    try:
+        row = conn.execute("SELECT last_ms FROM checks WHERE key = ?",(get_check_key(opts),)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    return row[0]
+
+def save_check_state(opts,read_last_ms,last_ms,new_buckets):
+    """Add the per minute counts of the lines searched up to last_ms, and return the count of the period.
+
+    The period is counted by whole minutes, the minute it starts in is counted whole.
+
+    When a concurrent run has already moved the check on since read_last_ms, its
+    counts are kept and this run's are dropped, so no line is counted twice.
+    """
+
+    window_ms = last_ms - opts['minute'] * 60000
+    conn = open_state_db()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT last_ms,buckets FROM checks WHERE key = ?",(get_check_key(opts),)).fetchone()
+        stored_last_ms,buckets = (row[0],json.loads(row[1])) if row else (None,{})
+        if stored_last_ms == read_last_ms:
+            for minute_ms,count in new_buckets.items():
+                buckets[minute_ms] = buckets.get(minute_ms,0) + count
+            # drop the minutes that ended before the period
+            buckets = dict((minute_ms,count) for minute_ms,count in buckets.items() if int(minute_ms) + 60000 > window_ms)
+            conn.execute("INSERT OR REPLACE INTO checks (key,last_ms,buckets) VALUES (?,?,?)",
+                         (get_check_key(opts),last_ms,json.dumps(buckets)))
+        conn.commit()
+    finally:
+        conn.close()
+
+    return sum(count for minute_ms,count in buckets.items() if int(minute_ms) + 60000 > window_ms)
+
+def get_results(opts):
+    """Get results with given parameters."""
+
+    url = "https://{0}/{1}/_search".format(opts['domain'],opts['index'])
+
+    username = opts['auth'].split(':')[0]
+    password = opts['auth'].split(':')[1]
+    httpauth = HTTPBasicAuth(username, password)
+
+    if opts['incremental']:
+        # from the end of the last search of the check, or the whole period the first time,
+        # up to a fixed time, so the next run starts exactly there
+        read_last_ms = load_check_state(opts)
+        lt = int(time.time() * 1000) - INGEST_LAG_MS
+        gte = lt - opts['minute'] * 60000
+        if read_last_ms is not None and read_last_ms > gte:
+            gte = read_last_ms
+        data = build_query(opts,gte,lt)
+        if opts['count']:
+            data["aggs"] = {"minute":{"date_histogram":{"field":"@timestamp","fixed_interval":"1m"}}}
+        else:
+            # newest first like a check without -r, counting all the new lines, so a backlog
+            # larger than a page is reported rather than left behind the checkpoint
+            data["size"] = INCREMENTAL_SIZE
+            data["track_total_hits"] = True
+    else:
+        data = build_query(opts)
+
     headers = {"Content-Type": "application/json; charset=utf-8"}
 
     try:
         res = requests.post(url, headers=headers, auth=httpauth, json=data, verify=False, timeout=5)
         if res.status_code == requests.codes.ok:
             res_dict = res.json()
-            hits_count = len(res_dict["hits"]["hits"])
             if not opts['count']:
-                if hits_count == 0:
+                hits = res_dict["hits"]["hits"]
+                if len(hits) == 0:
                     print("INFO: No such message found")
                 else:
-                    for i in range(hits_count):
-                        output = res_dict["hits"]["hits"][i]["_source"][opts['output']]
-                        print(output)
+                    for hit in hits:
+                        print(hit["_source"][opts['output']])
+                if opts['incremental']:
+                    if res_dict["hits"]["total"]["value"] > len(hits):
+                        print("INFO: {0} more new lines not shown".format(res_dict["hits"]["total"]["value"] - len(hits)))
+                    save_check_state(opts,read_last_ms,lt,{})
+            elif opts['incremental']:
+                new_buckets = dict((str(bucket["key"]),bucket["doc_count"]) for bucket in res_dict["aggregations"]["minute"]["buckets"]
+                                   if bucket["doc_count"])
+                print(save_check_state(opts,read_last_ms,lt,new_buckets))
             else:
-                print(hits_count)
+                print(res_dict["hits"]["total"]["value"])
+                if opts['group']:
+                    for bucket in res_dict["aggregations"]["group"]["buckets"]:
+                        print("{0} {1}".format(bucket["key"],bucket["doc_count"]))
+                if opts['bucket']:
+                    for bucket in res_dict["aggregations"]["bucket"]["buckets"]:
+                        print("{0} {1}".format(bucket["key_as_string"],bucket["doc_count"]))
 
             if opts['debug']:
                 print(json.dumps(res_dict,indent=2))
@@ -125,9 +286,300 @@ def get_results(opts):
 
     return True
 
+def save_export_state(state_file,state):
+    """Save the state of an export, replacing the previous one at once."""
+
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file,'w') as f:
+        json.dump(state,f)
+    os.rename(tmp_file,state_file)
+
+def export_results(opts):
+    """Write every line of the period as NDJSON, walking a point in time page by page with search_after.
+
+    After each page the state file records the point in time, the sort value of
+    the last hit and the size of the export, so an interrupted export truncates
+    the partial page and resumes from there over the same period, as long as the
+    check is the same and its export is still there. The implicit _shard_doc
+    tiebreaker of the sort values only holds in the same point in time, so once
+    it has expired the lines of the last exported millisecond are exported again
+    from a new one.
+    """
+
+    url = "https://{0}".format(opts['domain'])
+
+    username = opts['auth'].split(':')[0]
+    password = opts['auth'].split(':')[1]
+    httpauth = HTTPBasicAuth(username, password)
+
+    headers = {"Content-Type": "application/json; charset=utf-8"}
+
+    state_file = None
+    if opts['export'] != '-':
+        state_file = opts['export'] + '.state'
+
+    # the state only resumes the export of the same check
+    key = json.dumps([opts['domain'],opts['index'],opts['data'],opts['wildcard'],opts['minute'],opts['output']])
+
+    state = None
+    if state_file and os.path.exists(state_file):
+        with open(state_file) as f:
+            try:
+                state = json.load(f)
+            except ValueError:
+                state = None
+        if state is not None and state.get('key') != key:
+            state = None
+
+    if state is not None:
+        try:
+            export_f = open(opts['export'],'r+')
+        except OSError:
+            export_f = None
+        if export_f is not None and os.fstat(export_f.fileno()).st_size < state['size']:
+            export_f.close()
+            export_f = None
+        if export_f is None:
+            # the export of the state is gone or shorter than recorded, start a new one
+            state = None
+        else:
+            export_f.truncate(state['size'])
+            export_f.seek(state['size'])
+
+    if state is None:
+        # a fixed period, so a resumed export searches the same one
+        lt = int(time.time() * 1000)
+        state = {'key':key, 'gte':lt - opts['minute'] * 60000, 'lt':lt, 'pit_id':None, 'search_after':None, 'count':0, 'size':0,
+                 'last_ms':None, 'last_count':0, 'last_size':0}
+        export_f = sys.stdout if opts['export'] == '-' else open(opts['export'],'w')
+
+    def open_pit():
+        res = requests.post("{0}/{1}/_search/point_in_time?keep_alive={2}".format(url,opts['index'],PIT_KEEP_ALIVE),
+                            headers=headers, auth=httpauth, verify=False, timeout=5)
+        if res.status_code != requests.codes.ok:
+            print("StatusCode: {0}, Error: {1}".format(res.status_code,res.content))
+            return None
+        return res.json()["pit_id"]
+
+    pit_id = state['pit_id']
+    resumed_pit = pit_id is not None
+    done = False
+    try:
+        if not pit_id:
+            pit_id = open_pit()
+            if not pit_id:
+                return False
+
+        data = build_query(opts,state['gte'],state['lt'])
+        # with a point in time, the sort values of the hits end with its _shard_doc tiebreaker,
+        # no _id fielddata is loaded to break the ties of @timestamp
+        data["sort"] = [{"@timestamp":"asc"}]
+        data["size"] = PAGE_SIZE
+        data["_source"] = [opts['output']]
+        data["track_total_hits"] = False
+
+        while True:
+            data["pit"] = {"id":pit_id, "keep_alive":PIT_KEEP_ALIVE}
+            data.pop("search_after",None)
+            if state['search_after']:
+                data["search_after"] = state['search_after']
+
+            res = requests.post("{0}/_search".format(url), headers=headers, auth=httpauth, json=data, verify=False, timeout=30)
+            if res.status_code != requests.codes.ok and resumed_pit:
+                # the point in time of the interrupted export has expired, start again at the last exported millisecond
+                resumed_pit = False
+                pit_id = open_pit()
+                if not pit_id:
+                    return False
+                export_f.truncate(state['last_size'])
+                export_f.seek(state['last_size'])
+                state.update(count=state['last_count'], size=state['last_size'], search_after=None)
+                if state['last_ms'] is not None:
+                    state['gte'] = state['last_ms']
+                data["query"] = build_query(opts,state['gte'],state['lt'])["query"]
+                continue
+            if res.status_code != requests.codes.ok:
+                print("StatusCode: {0}, Error: {1}".format(res.status_code,res.content))
+                return False
+            resumed_pit = False
+            res_dict = res.json()
+            pit_id = res_dict.get("pit_id",pit_id)
+            hits = res_dict["hits"]["hits"]
+
+            for hit in hits:
+                # the first line of the last millisecond, where a new point in time has to start again
+                if hit["sort"][0] != state['last_ms']:
+                    state.update(last_ms=hit["sort"][0], last_count=state['count'], last_size=state['size'])
+                line = json.dumps(hit["_source"]) + '\n'
+                export_f.write(line)
+                state['count'] = state['count'] + 1
+                # json.dumps escapes to ASCII, so the characters are the bytes
+                state['size'] = state['size'] + len(line)
+            export_f.flush()
+
+            if hits:
+                state['search_after'] = hits[-1]["sort"]
+                state['pit_id'] = pit_id
+                if state_file:
+                    save_export_state(state_file,state)
+            if len(hits) < PAGE_SIZE:
+                break
+
+        done = True
+        if state_file:
+            os.remove(state_file)
+            print("INFO: Exported {0} lines to {1}".format(state['count'],opts['export']))
+
+    except KeyError:
+        print("Exception: KeyError")
+        if opts['debug']:
+            print(json.dumps(res_dict,indent=2))
+
+    except requests.exceptions.Timeout:
+        print("Exception: Timeout")
+
+    except requests.exceptions.ConnectionError:
+        print("Exception: ConnectionError")
+
+    finally:
+        if export_f is not sys.stdout:
+            export_f.close()
+        # an interrupted export keeps its point in time until it expires, for the resumed one
+        if pit_id and (done or not state_file):
+            try:
+                requests.delete("{0}/_search/point_in_time".format(url), headers=headers, auth=httpauth, json={"pit_id":[pit_id]},
+                                verify=False, timeout=5)
+            except requests.exceptions.RequestException:
+                pass
+
+    return True
+
+def zabbix_quote(value):
+    """Quote a value for zabbix_sender input, which reads one item per line."""
+
+    value = str(value)
+    if value and not any(c in value for c in ' \t\n"\\'):
+        return value
+    value = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '"{0}"'.format(value)
+
+def load_checks(batch,opts):
+    """Load the checks of a batch file, one JSON object per line, with the defaults of the command line."""
+
+    if batch == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(batch) as f:
+            lines = f.readlines()
+
+    checks = []
+    for line_number,line in enumerate(lines,1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            check = json.loads(line)
+        except ValueError as e:
+            print("Invalid check on line {0} of {1}: {2}".format(line_number,batch,str(e)))
+            sys.exit(2)
+        if not check.get('data') or any(':' not in kv_item for kv_item in check['data'].split(',')):
+            print("Invalid check on line {0} of {1}. Expected data key1:value1,key2:value2,...".format(line_number,batch))
+            sys.exit(2)
+        for k in ['index','output','minute']:
+            check.setdefault(k,opts[k])
+        for k in ['wildcard','count']:
+            check.setdefault(k,False)
+        check['group'] = None
+        check['bucket'] = None
+        checks.append(check)
+
+    return checks
+
+def get_check_output(check,response):
+    """Get the output of one check from its response in _msearch, the count or else the latest output."""
+
+    if "error" in response:
+        return "StatusCode: {0}, Error: {1}".format(response.get("status"),json.dumps(response["error"]))
+    try:
+        if check['count']:
+            return response["hits"]["total"]["value"]
+        if not response["hits"]["hits"]:
+            return "INFO: No such message found"
+        return response["hits"]["hits"][0]["_source"][check['output']]
+    except KeyError:
+        return "Exception: KeyError"
+
+def get_batch_results(opts):
+    """Run the checks of a batch file in _msearch requests and print one zabbix_sender line per check."""
+
+    url = "https://{0}/_msearch".format(opts['domain'])
+
+    username = opts['auth'].split(':')[0]
+    password = opts['auth'].split(':')[1]
+    httpauth = HTTPBasicAuth(username, password)
+
+    headers = {"Content-Type": "application/x-ndjson; charset=utf-8"}
+
+    checks = load_checks(opts['batch'],opts)
+
+    # one session, so the requests of all the chunks share one connection
+    session = requests.Session()
+    for i in range(0,len(checks),MSEARCH_SIZE):
+        chunk = checks[i:i + MSEARCH_SIZE]
+        lines = []
+        for check in chunk:
+            data = build_query(check)
+            if not check['count']:
+                # only the latest line is reported
+                data["size"] = 1
+                data["_source"] = [check['output']]
+            lines.append(json.dumps({"index":check['index']}))
+            lines.append(json.dumps(data))
+        body = '\n'.join(lines) + '\n'
+
+        # an _msearch that fails as a whole fails every check of it the way get_results would
+        failure = None
+        try:
+            res = session.post(url, headers=headers, auth=httpauth, data=body.encode('utf-8'), verify=False, timeout=5 + len(chunk) // 10)
+            if res.status_code == requests.codes.ok:
+                responses = res.json()["responses"]
+                if len(responses) != len(chunk):
+                    failure = "Exception: IndexError"
+            else:
+                failure = "StatusCode: {0}, Error: {1}".format(res.status_code,res.content)
+        except requests.exceptions.Timeout:
+            failure = "Exception: Timeout"
+        except requests.exceptions.ConnectionError:
+            failure = "Exception: ConnectionError"
+        except ValueError:
+            # a 200 reply that is not JSON, e.g. from a proxy
+            failure = "Exception: ValueError"
+        except (KeyError,TypeError):
+            # a JSON reply without responses
+            failure = "Exception: KeyError"
+
+        for j,check in enumerate(chunk):
+            if failure:
+                response = {}
+                output = failure
+            else:
+                response = responses[j]
+                output = get_check_output(check,response)
+            key = check.get('key') or "check_opensearch_keywords[{0},{1}]".format(check['index'],check['data'])
+            print("{0} {1} {2}".format(zabbix_quote(check.get('host') or opts['host']),zabbix_quote(key),zabbix_quote(output)))
+            if opts['debug']:
+                print(json.dumps(response,indent=2))
+
+    return True
+
 def main():
     opts = parse_opts()
-    get_results(opts)
+    if opts['batch']:
+        get_batch_results(opts)
+    elif opts['export']:
+        export_results(opts)
+    else:
+        get_results(opts)
 
     return 0
 
@@ -7,10 +7,52 @@
 import os
 import re
 import sys
-import yaml
+import glob
+import gzip
+import json
+import time
+import signal
+import calendar
+import collections
+import socket
+import sqlite3
+import hashlib
 
+SEEK_DB = '/var/tmp/logs_seek_pos.db'
+
+# the previous state file, imported into SEEK_DB once on first use
 YAML_DATA = '/var/tmp/logs_seek_pos.yml'
 
+# bumped when the tables of SEEK_DB change, older stores are upgraded on first use
+SCHEMA_VERSION = 2
+
+# read the unread tail in fixed-size chunks, so memory use does not depend on the backlog size
+CHUNK_SIZE = 1024 * 1024
+
+# strings without any of these are counted with a plain substring search
+REGEX_METACHARS = '.^$*+?{}[]\\|()'
+
+# the first bytes of a log are fingerprinted to recognise it after logrotate renames, compresses or truncates it
+HEAD_SIZE = 1024
+
+# logs with these suffixes are decompressed as a stream, their offsets count decompressed bytes
+COMPRESSED_SUFFIXES = ('.gz','.zst')
+
+# the suffixes logrotate adds to a rotated log, numbered or dateext, optionally compressed
+ROTATED_SUFFIX_RE = re.compile(r'(?:\.\d+|-\d[\d-]*)(?:{0})?$'.format('|'.join(re.escape(suffix) for suffix in COMPRESSED_SUFFIXES)))
+
+# with --parallel, backlogs smaller than this are still scanned in one process
+PARALLEL_MIN_SIZE = 64 * 1024 * 1024
+
+# timestamps parsed from matching lines for --histogram: syslog, ISO 8601 and nginx/apache access logs
+SYSLOG_TS_RE = re.compile(br'^([A-Z][a-z]{2}) +(\d{1,2}) (\d{2}):(\d{2}):(\d{2})')
+ISO_TS_RE = re.compile(br'(\d{4})[-/](\d{2})[-/](\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:[.,]\d+)?(Z|[+-]\d{2}:?\d{2})?')
+ACCESS_TS_RE = re.compile(br'\[(\d{2})/([A-Z][a-z]{2})/(\d{4}):(\d{2}):(\d{2}):(\d{2}) ([+-]\d{4})\]')
+MONTHS = dict((name.encode('ascii'),i) for i,name in enumerate(calendar.month_abbr) if name)
+
+# with --follow, counts are sent as zabbix_sender input lines with this item key
+ZABBIX_KEY = 'log_seek_count'
+
 def parse_opts():
     """Help messages(-h, --help)."""
 
@@ -26,12 +68,55 @@ def parse_opts():
           {0} --file_path /var/log/messages --seek_str "kernel:\s\[[\d\.]+\]\svw\[\d+\]:\ssegfault"
           {0} --file_path /var/log/messages --seek_str "mdadm.*: Rebuild.*event detected"
           {0} --file_path /var/log/nginx/error.log --seek_str "style.css" --ignore_str "No such file or directory"
+          {0} --file_path /var/log/messages --pattern mce="HANDLING MCE MEMORY ERROR" --pattern mdadm="mdadm.*: Rebuild.*event detected"
+          {0} --file_path /var/log/nginx/error.log --pattern css="style.css" --ignore css="No such file or directory" --pattern js="\.js"
+          {0} --file_path /var/log/messages --seek_str "HANDLING MCE MEMORY ERROR" --parallel 8
+          {0} --file_path "/var/log/archive/messages-*" --seek_str "HANDLING MCE MEMORY ERROR"
+          {0} --file_path "/var/log/messages*" --seek_str "HANDLING MCE MEMORY ERROR"
+          {0} --file_path /var/log/archive/messages-20261018.zst --seek_str "HANDLING MCE MEMORY ERROR"
+          {0} --file_path "/var/log/containers/*.log" --seek_str "OutOfMemoryError" --threads 16
+          {0} --file_path /var/log/containers --seek_str "OutOfMemoryError" --per_file
+          {0} --file_path /var/log/messages --seek_str "segfault" --histogram 60
+          {0} --file_path /var/log/messages --seek_str "segfault" --histogram 300 --output zabbix | zabbix_sender -c /etc/zabbix/zabbix_agentd.conf -T -i -
+          {0} --file_path /var/log/messages --seek_str "segfault" --samples 5
+          {0} --file_path /var/log/messages --seek_str "segfault" --samples 5 --samples_file /var/tmp/segfault_samples.json
+          {0} --file_path /var/log/messages --pattern mce="HANDLING MCE MEMORY ERROR" --follow --interval 60 | zabbix_sender -c /etc/zabbix/zabbix_agentd.conf -T -r -i -
+          {0} --file_path /var/log/messages --pattern mce="HANDLING MCE MEMORY ERROR" --follow --socket /run/log_seek_count.sock
+          {0} --config /etc/zabbix/log_seek_checks.yml --output zabbix | zabbix_sender -c /etc/zabbix/zabbix_agentd.conf -T -i -
+
+          /etc/zabbix/log_seek_checks.yml:
+          ---
+          checks:
+            - file_path: /var/log/messages
+              name: mce
+              seek_str: HANDLING MCE MEMORY ERROR
+            - file_path: /var/log/messages
+              seek_str: mdadm.*: Rebuild.*event detected
+            - file_path: /var/log/nginx/error.log
+              seek_str: style.css
+              ignore_str: No such file or directory
         '''.format(__file__)
         ))
 
-    parser.add_argument('--file_path', type=str, required=True, help='the file path')
-    parser.add_argument('--seek_str', type=str, required=True, help='the string to seek')
+    parser.add_argument('--file_path', type=str, help='the file path, glob or directory, .gz and .zst files are decompressed as a stream, the rotated files of a matched log are counted through it')
+    parser.add_argument('--config', type=str, help='YAML file of checks to run in one process, each file is read once')
+    seek_group = parser.add_mutually_exclusive_group()
+    seek_group.add_argument('--seek_str', type=str, help='the string to seek')
+    seek_group.add_argument('--pattern', type=str, action='append', help='name=string to seek, can be repeated and scanned in one pass')
     parser.add_argument('--ignore_str', type=str, help='the string to ignore')
+    parser.add_argument('--ignore', type=str, action='append', help='name=string to ignore for the pattern of the same name')
+    parser.add_argument('--parallel', type=int, default=0, help='scan a huge backlog in N processes, unless several changed files are scanned in threads [default: 0, disabled]')
+    parser.add_argument('--threads', type=int, default=8, help='scan the changed files of a glob or directory in N threads [default: 8]')
+    parser.add_argument('--per_file', action="store_true", default=False, help='also print the count of each file of a glob or directory as JSON')
+    parser.add_argument('--histogram', type=int, metavar='SECONDS', help='also count the matching lines per interval of their timestamps')
+    parser.add_argument('--samples', type=int, default=0, help='keep the first and last N matching lines with their offsets')
+    parser.add_argument('--samples_file', type=str, help='write the samples as JSON to this file instead of stdout')
+    parser.add_argument('--output', type=str, choices=['json','zabbix'], default='json', help='output format of --histogram and --config [default: json]')
+    parser.add_argument('--follow', action="store_true", default=False, help='keep running, and send the counts in zabbix_sender input format every interval')
+    parser.add_argument('--interval', type=int, default=60, help='seconds between sending counts and saving checkpoints in follow mode [default: 60]')
+    parser.add_argument('--poll', type=float, default=1.0, help='seconds between checking the file for new lines in follow mode [default: 1]')
+    parser.add_argument('--zabbix_host', type=str, default='-', help='host name in the zabbix_sender lines [default: -, the agent hostname]')
+    parser.add_argument('--socket', type=str, help='unix socket to send the zabbix_sender lines to [default: stdout]')
 
     if len(sys.argv) < 2:
         parser.print_help()
@@ -39,69 +124,1001 @@ def parse_opts():
 
     args = parser.parse_args()
 
-    return {'file_path':args.file_path, 'seek_str':args.seek_str, 'ignore_str':args.ignore_str}
+    if args.config:
+        if args.file_path or args.seek_str or args.pattern:
+            parser.error("--config can't be used with --file_path, --seek_str or --pattern")
+    elif not args.file_path or not (args.seek_str or args.pattern):
+        parser.error("--file_path and one of --seek_str or --pattern are required without --config")
 
-def get_last_seek_pos(file_path,seek_str):
-    with open(YAML_DATA) as f:
-        data_dict = yaml.load(f)
-        if not data_dict['logs'].has_key(file_path):
-            last_seek_pos = 0
-        else:
-            if not data_dict['logs'][file_path].has_key(seek_str):
-                last_seek_pos = 0
-            else:
-                last_seek_pos = data_dict['logs'][file_path][seek_str]
+    patterns = []
+    if args.seek_str:
+        patterns.append({'name':args.seek_str, 'seek_str':args.seek_str, 'ignore_str':args.ignore_str})
+    if args.pattern:
+        ignore_dict = {}
+        for item in args.ignore or []:
+            if '=' not in item:
+                parser.error("invalid --ignore '{0}', expected name=string".format(item))
+            name,ignore_str = item.split('=',1)
+            ignore_dict[name] = ignore_str
+        for item in args.pattern:
+            if '=' not in item:
+                parser.error("invalid --pattern '{0}', expected name=string".format(item))
+            name,seek_str = item.split('=',1)
+            if name in [pattern['name'] for pattern in patterns]:
+                parser.error("duplicate --pattern name '{0}'".format(name))
+            patterns.append({'name':name, 'seek_str':seek_str, 'ignore_str':ignore_dict.get(name)})
 
-    return last_seek_pos
+    if args.parallel < 0:
+        parser.error("--parallel must not be negative")
+    if args.threads < 1:
+        parser.error("--threads must be positive")
+    if args.interval <= 0 or args.poll <= 0:
+        parser.error("--interval and --poll must be positive")
+    if args.histogram is not None and args.histogram <= 0:
+        parser.error("--histogram must be positive")
+    if args.samples < 0:
+        parser.error("--samples must not be negative")
+    if args.follow and (args.samples or args.histogram or args.per_file):
+        parser.error("--samples, --histogram and --per_file can't be used with --follow")
+    if args.samples and args.output == 'zabbix' and not args.samples_file:
+        parser.error("--samples with --output zabbix requires --samples_file")
 
-def save_last_seek_pos(file_path,last_seek_pos,seek_str):
+    return {'file_path':args.file_path, 'config':args.config, 'seek_str':args.seek_str, 'ignore_str':args.ignore_str, 'patterns':patterns, 'parallel':args.parallel,
+            'threads':args.threads, 'per_file':args.per_file, 'histogram':args.histogram, 'samples':args.samples, 'samples_file':args.samples_file, 'output':args.output, 'follow':args.follow, 'interval':args.interval, 'poll':args.poll, 'zabbix_host':args.zabbix_host, 'socket':args.socket}
+
+def import_yaml_data(conn):
+    """Import the checkpoints of the old YAML state file."""
+
+    if not os.path.exists(YAML_DATA):
+        return 0
 
-    seek_f = open(file_path,'r')
-    seek_f.seek(0,2)
-    last_seek_pos = seek_f.tell()
-    seek_f.close()
+    import yaml
 
     with open(YAML_DATA) as f:
-        data_dict = yaml.load(f)
-        if not data_dict['logs'].has_key(file_path):
-            data_dict['logs'][file_path] = {}
+        data_dict = yaml.safe_load(f) or {}
+
+    imported = 0
+    for file_path,file_dict in (data_dict.get('logs') or {}).items():
+        for seek_str,entry in (file_dict or {}).items():
+            if not isinstance(entry,dict):
+                entry = {'pos':entry}
+            save_entry(conn,file_path,seek_str,entry)
+            imported = imported + 1
+
+    return imported
+
+def open_seek_db():
+    """Open the checkpoint store, creating or upgrading it and importing YAML_DATA on first use."""
+
+    # sqlite locks the file and commits every transaction atomically, so concurrent runs don't lose updates
+    conn = sqlite3.connect(SEEK_DB,timeout=30,isolation_level=None)
+    try:
+        # a plain read, so runs of an up to date store don't queue up for the write lock
+        row = conn.execute("SELECT value FROM meta WHERE key = 'schema_version'").fetchone()
+        if row is not None and row[0] == str(SCHEMA_VERSION):
+            return conn
+    except sqlite3.OperationalError:
+        # no meta table yet
+        pass
+
+    # WAL is kept in the file, so it is only set up here
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        conn.execute("CREATE TABLE IF NOT EXISTS seek_pos (file_path TEXT, seek_str TEXT, pos INTEGER, "
+                     "dev INTEGER, inode INTEGER, head TEXT, head_len INTEGER, PRIMARY KEY (file_path, seek_str))")
+        # added later, so stores created before get them here
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(seek_pos)")]
+        for column in ['file_size','mtime']:
+            if column not in columns:
+                conn.execute("ALTER TABLE seek_pos ADD COLUMN {0} INTEGER".format(column))
+        if conn.execute("SELECT value FROM meta WHERE key = 'yaml_imported'").fetchone() is None:
+            import_yaml_data(conn)
+            conn.execute("INSERT INTO meta (key, value) VALUES ('yaml_imported', ?)",(YAML_DATA,))
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('schema_version', ?)",(str(SCHEMA_VERSION),))
+        conn.execute("COMMIT")
+    except:
+        conn.execute("ROLLBACK")
+        conn.close()
+        raise
 
-        data_dict['logs'][file_path][seek_str] = last_seek_pos
+    return conn
 
-    with open(YAML_DATA, 'w') as f:
-        yaml.dump(data_dict, f, default_flow_style=False)
+def save_entry(conn,file_path,seek_str,entry):
+    conn.execute("INSERT OR REPLACE INTO seek_pos (file_path, seek_str, pos, dev, inode, head, head_len, file_size, mtime) "
+                 "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                 (file_path,seek_str,entry['pos'],entry.get('dev'),entry.get('inode'),entry.get('head'),entry.get('head_len'),
+                  entry.get('file_size'),entry.get('mtime')))
+
+def get_last_seek_entries(file_path,seek_strs):
+    return get_all_seek_entries({file_path:seek_strs})[file_path]
+
+def get_all_seek_entries(seek_strs_dict):
+    """Get the checkpoint of each seek_str of each file, an old plain offset is read as an entry without identity."""
+
+    conn = open_seek_db()
+    try:
+        # one read transaction, a consistent snapshot that doesn't block the writers in WAL mode
+        conn.execute("BEGIN")
+        all_entries = {}
+        for file_path,seek_strs in seek_strs_dict.items():
+            seek_entries = {}
+            for seek_str in seek_strs:
+                row = conn.execute("SELECT pos, dev, inode, head, head_len, file_size, mtime FROM seek_pos WHERE file_path = ? AND seek_str = ?",
+                                   (file_path,seek_str)).fetchone()
+                if row is None:
+                    entry = {'pos':0}
+                elif row[2] is None:
+                    entry = {'pos':row[0]}
+                else:
+                    entry = {'pos':row[0], 'dev':row[1], 'inode':row[2], 'head':row[3], 'head_len':row[4],
+                             'file_size':row[5], 'mtime':row[6]}
+                seek_entries[seek_str] = entry
+            all_entries[file_path] = seek_entries
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+    return all_entries
+
+def save_last_seek_entries(file_path,seek_entries):
+    return save_all_seek_entries({file_path:seek_entries})
+
+def save_all_seek_entries(all_entries):
+    """Save the checkpoints of many files in one transaction."""
+
+    conn = open_seek_db()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        for file_path,seek_entries in all_entries.items():
+            for seek_str,entry in seek_entries.items():
+                save_entry(conn,file_path,seek_str,entry)
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
 
     return True
 
-def get_seek_count(file_path,seek_str,ignore_str=None):
-    last_seek_pos = get_last_seek_pos(file_path,seek_str)
+def is_compressed(file_path):
+    return file_path.endswith(COMPRESSED_SUFFIXES)
+
+def open_log(file_path):
+    """Open a plain, gzip or zstd log for reading, compressed logs are decompressed as a stream."""
+
+    if file_path.endswith('.gz'):
+        return gzip.open(file_path,'rb')
+    if file_path.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            sys.stderr.write("ERROR: Requires zstandard to read '{0}', try 'pip install zstandard'.\n".format(file_path))
+            sys.exit(2)
+        return zstandard.ZstdDecompressor().stream_reader(open(file_path,'rb'),read_across_frames=True,closefd=True)
+    return open(file_path,'rb')
+
+def head_fingerprint(head,head_len=HEAD_SIZE):
+    return hashlib.md5(head[:head_len]).hexdigest()
+
+def get_identity(file_path,seek_f):
+    """Get the device, inode and head of an open log file, the size is unknown for compressed ones."""
+
+    if is_compressed(file_path):
+        f_stat = os.stat(file_path)
+        size = None
+    else:
+        f_stat = os.fstat(seek_f.fileno())
+        size = f_stat.st_size
+    head = seek_f.read(HEAD_SIZE)
+    return {'dev':f_stat.st_dev, 'inode':f_stat.st_ino, 'head':head_fingerprint(head), 'head_len':len(head),
+            'head_bytes':head, 'size':size, 'file_size':f_stat.st_size, 'mtime':f_stat.st_mtime_ns}
+
+def is_same_log(entry,identity):
+    """Whether a checkpoint entry still points into the log file."""
+
+    if 'inode' not in entry:
+        # an old plain offset, only a shrunk file tells us it was rotated
+        return identity['size'] is None or entry['pos'] <= identity['size']
+    if (entry['dev'],entry['inode']) != (identity['dev'],identity['inode']):
+        return False
+    if identity['size'] is not None and entry['pos'] > identity['size']:
+        return False
+    if entry['head_len'] > identity['head_len']:
+        return False
+    # copytruncate keeps the inode, but the head changes once new lines are written
+    return head_fingerprint(identity['head_bytes'],entry['head_len']) == entry['head']
+
+def find_rotated_log(file_path,entry):
+    """Find the rotated file (.1, .1.gz, .1.zst, dateext) a checkpoint entry points into."""
+
+    rotated_paths = []
+    for suffix in ['.1','.0']:
+        rotated_paths.append(file_path + suffix)
+        rotated_paths.extend(file_path + suffix + compressed_suffix for compressed_suffix in COMPRESSED_SUFFIXES)
+    rotated_paths.extend(sorted(glob.glob(file_path + '-*'),key=os.path.getmtime,reverse=True))
+
+    for rotated_path in rotated_paths:
+        if not os.path.isfile(rotated_path):
+            continue
+        if not is_compressed(rotated_path):
+            f_stat = os.stat(rotated_path)
+            if (f_stat.st_dev,f_stat.st_ino) == (entry['dev'],entry['inode']):
+                return rotated_path
+        try:
+            with open_log(rotated_path) as rotated_f:
+                head = rotated_f.read(entry['head_len'])
+        except (IOError,EOFError):
+            continue
+        if len(head) == entry['head_len'] and head_fingerprint(head) == entry['head']:
+            return rotated_path
+
+    return None
+
+def read_blocks(seek_f,start_pos,stop_pos=None,chunk_size=CHUNK_SIZE):
+    """Yield blocks of complete lines and the offset right after each block, up to stop_pos if given."""
+
+    seek_f.seek(start_pos,0)
+    end_pos = start_pos
+    read_pos = start_pos
+    tail = b''
+    while True:
+        if stop_pos is not None:
+            chunk_size = min(chunk_size,stop_pos - read_pos)
+            if chunk_size <= 0:
+                break
+        chunk = seek_f.read(chunk_size)
+        read_pos = read_pos + len(chunk)
+        if not chunk:
+            break
+        buf = tail + chunk
+        cut = buf.rfind(b'\n') + 1
+        if cut == 0:
+            # no line break yet, keep the partial line for the next chunk
+            tail = buf
+            continue
+        tail = buf[cut:]
+        end_pos = end_pos + cut
+        yield buf[:cut], end_pos
+
+def is_literal(seek_str):
+    """Whether the string has no regex metacharacters and can be found with a plain substring search."""
+
+    return not any(c in REGEX_METACHARS for c in seek_str)
 
-    seek_f = open(file_path,'r')
-    seek_f.seek(last_seek_pos,0)
-    seek_count = 0
-    lines = seek_f.readlines()
-    for line in lines:
+def compile_matchers(patterns):
+    """Compile the patterns once, and an alternation of the ASCII regex ones to find candidate lines.
+
+    Literal strings are searched as UTF-8 bytes, which finds the same lines as
+    searching the decoded text. A bytes regex only matches like the decoded
+    line for ASCII patterns on ASCII lines, so every regex is also compiled as
+    str for the other lines. The seek_re ones find candidates in a block, the
+    line_re ones check a line with its line break like the old line by line scan.
+    """
+
+    matchers = []
+    for pattern in patterns:
+        seek_str = pattern['seek_str']
+        ignore_str = pattern.get('ignore_str')
+        matcher = {'name':pattern['name'], 'seek_str':seek_str, 'literal':None, 'seek_re':None, 'line_re':None,
+                   'seek_bytes_re':None, 'line_bytes_re':None, 'ignore_literal':None, 'ignore_re':None, 'ignore_bytes_re':None,
+                   'in_any_re':False}
+        if is_literal(seek_str):
+            matcher['literal'] = seek_str.encode('utf-8')
+        else:
+            matcher['seek_re'] = re.compile(seek_str,re.MULTILINE)
+            matcher['line_re'] = re.compile(seek_str)
+            if seek_str.isascii():
+                matcher['seek_bytes_re'] = re.compile(seek_str.encode('ascii'),re.MULTILINE)
+                matcher['line_bytes_re'] = re.compile(seek_str.encode('ascii'))
         if ignore_str is not None:
-            if re.search(seek_str,line) and not re.search(ignore_str,line):
-                seek_count = seek_count + 1
+            if is_literal(ignore_str):
+                matcher['ignore_literal'] = ignore_str.encode('utf-8')
+            else:
+                matcher['ignore_re'] = re.compile(ignore_str)
+                if ignore_str.isascii():
+                    matcher['ignore_bytes_re'] = re.compile(ignore_str.encode('ascii'))
+        matchers.append(matcher)
+
+    # the alternation renumbers the groups, so a backreference would point at another pattern's group,
+    # the patterns with groups are searched with their own regex
+    any_matchers = [matcher for matcher in matchers if matcher['seek_bytes_re'] is not None and matcher['seek_bytes_re'].groups == 0]
+    if len(any_matchers) < 2:
+        return matchers,None
+
+    try:
+        any_re = re.compile('|'.join('(?:{0})'.format(matcher['seek_str']) for matcher in any_matchers).encode('ascii'),re.MULTILINE)
+    except re.error:
+        # e.g. inline flags that cannot be combined
+        return matchers,None
+
+    for matcher in any_matchers:
+        matcher['in_any_re'] = True
+    return matchers,any_re
+
+def is_ignored(line,matcher):
+    """Whether a line, with its line break, matches the ignore string of a pattern."""
+
+    if matcher['ignore_literal'] is not None:
+        return matcher['ignore_literal'] in line
+    if matcher['ignore_bytes_re'] is not None and line.isascii():
+        return matcher['ignore_bytes_re'].search(line) is not None
+    if matcher['ignore_re'] is not None:
+        return matcher['ignore_re'].search(line.decode('utf-8','surrogateescape')) is not None
+    return False
+
+def parse_timestamp(line):
+    """Parse the first syslog, ISO 8601 or access log timestamp of a line to epoch seconds."""
+
+    m = SYSLOG_TS_RE.match(line)
+    if m:
+        now = time.time()
+        month,day,hour,minute,second = MONTHS.get(m.group(1)),int(m.group(2)),int(m.group(3)),int(m.group(4)),int(m.group(5))
+        if month is None:
+            return None
+        # syslog has no year, a date in the future is from last year
+        year = time.localtime(now).tm_year
+        timestamp = time.mktime((year,month,day,hour,minute,second,0,0,-1))
+        if timestamp > now + 86400:
+            timestamp = time.mktime((year - 1,month,day,hour,minute,second,0,0,-1))
+        return int(timestamp)
+
+    m = ISO_TS_RE.search(line)
+    if m:
+        fields = tuple(int(m.group(i)) for i in range(1,7))
+        tz = m.group(7)
+        if tz is None:
+            return int(time.mktime(fields + (0,0,-1)))
+        offset = 0
+        if tz != b'Z':
+            tz = tz.replace(b':',b'')
+            offset = (int(tz[1:3]) * 60 + int(tz[3:5])) * 60
+            if tz[:1] == b'-':
+                offset = -offset
+        return calendar.timegm(fields + (0,0,0)) - offset
+
+    m = ACCESS_TS_RE.search(line)
+    if m:
+        month = MONTHS.get(m.group(2))
+        if month is None:
+            return None
+        tz = m.group(7)
+        offset = (int(tz[1:3]) * 60 + int(tz[3:5])) * 60
+        if tz[:1] == b'-':
+            offset = -offset
+        fields = (int(m.group(3)),month,int(m.group(1)),int(m.group(4)),int(m.group(5)),int(m.group(6)))
+        return calendar.timegm(fields + (0,0,0)) - offset
+
+    return None
+
+def new_recorder(patterns,histogram=None,samples=0):
+    """Create the per-pattern details kept about matching lines, beyond their count.
+
+    With samples, the first and last N matching lines are kept, the last ones
+    in a ring buffer, so memory use does not depend on the number of matches.
+    """
+
+    recorder = {'histogram':histogram, 'samples':samples, 'log_path':None, 'names':{}}
+    for pattern in patterns:
+        recorder['names'][pattern['name']] = {'buckets':{}, 'unparsed':0, 'first':[], 'last':collections.deque(maxlen=samples)}
+
+    return recorder
+
+def record_match(recorder,name,line,line_pos):
+    """Add a matching line to the recorder, only called for matching lines so the fast path stays fast."""
+
+    details = recorder['names'][name]
+    if recorder['histogram']:
+        timestamp = parse_timestamp(line)
+        if timestamp is None:
+            details['unparsed'] = details['unparsed'] + 1
         else:
-            if re.search(seek_str,line):
-                seek_count = seek_count + 1
-    seek_f.close()
+            bucket = timestamp - timestamp % recorder['histogram']
+            details['buckets'][bucket] = details['buckets'].get(bucket,0) + 1
+    if recorder['samples']:
+        sample = {'file_path':recorder['log_path'], 'offset':line_pos, 'line':line.decode('utf-8','replace')}
+        if len(details['first']) < recorder['samples']:
+            details['first'].append(sample)
+        else:
+            details['last'].append(sample)
 
-    save_last_seek_pos(file_path,last_seek_pos,seek_str)
+def merge_recorder(recorder,other):
+    """Add the details of a later range of the log to the recorder."""
 
-    return seek_count
+    for name,other_details in other['names'].items():
+        details = recorder['names'][name]
+        for bucket,count in other_details['buckets'].items():
+            details['buckets'][bucket] = details['buckets'].get(bucket,0) + count
+        details['unparsed'] = details['unparsed'] + other_details['unparsed']
+        # the first samples of the other range fill up ours, the rest go through the ring buffer
+        for sample in list(other_details['first']) + list(other_details['last']):
+            if len(details['first']) < recorder['samples']:
+                details['first'].append(sample)
+            else:
+                details['last'].append(sample)
 
-def main():
-    if not os.path.exists(YAML_DATA):
-        with open(YAML_DATA, "w") as seek_f:
-            seek_f.write("logs: {}")
+def count_literal(block,block_pos,matcher,seek_counts,start_pos,recorder=None):
+    """Count the lines including a literal string, only splitting out the lines around each hit."""
+
+    literal = matcher['literal']
+    i = max(start_pos - block_pos,0)
+    while i < len(block):
+        hit = block.find(literal,i)
+        if hit < 0:
+            break
+        line_start = block.rfind(b'\n',0,hit) + 1
+        line_end = block.find(b'\n',hit)
+        line = block[line_start:line_end + 1]
+        if not is_ignored(line,matcher):
+            seek_counts[matcher['name']] = seek_counts[matcher['name']] + 1
+            if recorder is not None:
+                record_match(recorder,matcher['name'],line[:-1],block_pos + line_start)
+        i = line_end + 1
+
+def count_regex(block,block_pos,matchers,seek_counts,start_pos_dict,candidate_re,recorder=None):
+    """Count the lines of an ASCII block matching each ASCII regex, only checking the lines where candidate_re hits."""
+
+    i = max(min(start_pos_dict[matcher['seek_str']] for matcher in matchers) - block_pos,0)
+    while i < len(block):
+        hit = candidate_re.search(block,i)
+        if hit is None:
+            break
+        line_start = block.rfind(b'\n',0,hit.start()) + 1
+        line_end = block.find(b'\n',line_start)
+        line = block[line_start:line_end + 1]
+        for matcher in matchers:
+            # skip the lines already counted by this pattern in an earlier run
+            if block_pos + line_start < start_pos_dict[matcher['seek_str']]:
+                continue
+            if matcher['line_bytes_re'].search(line) and not is_ignored(line,matcher):
+                seek_counts[matcher['name']] = seek_counts[matcher['name']] + 1
+                if recorder is not None:
+                    record_match(recorder,matcher['name'],line[:-1],block_pos + line_start)
+        i = line_end + 1
+
+def count_regex_text(text,block_pos,matcher,seek_counts,start_pos,recorder=None):
+    """Count the lines of a decoded block matching a regex, keeping track of the byte offset of each line."""
+
+    i = 0
+    text_pos = 0
+    line_pos = block_pos
+    while i < len(text):
+        hit = matcher['seek_re'].search(text,i)
+        if hit is None:
+            break
+        line_start = text.rfind('\n',0,hit.start()) + 1
+        line_end = text.find('\n',line_start)
+        line_pos = line_pos + len(text[text_pos:line_start].encode('utf-8','surrogateescape'))
+        text_pos = line_start
+        line = text[line_start:line_end + 1]
+        if line_pos >= start_pos and matcher['line_re'].search(line):
+            line = line.encode('utf-8','surrogateescape')
+            if not is_ignored(line,matcher):
+                seek_counts[matcher['name']] = seek_counts[matcher['name']] + 1
+                if recorder is not None:
+                    record_match(recorder,matcher['name'],line[:-1],line_pos)
+        i = line_end + 1
+
+def count_block(block,block_pos,matchers,seek_counts,start_pos_dict,any_re=None,recorder=None):
+    """Count the lines in a block matching each pattern but not its ignore string."""
+
+    regex_matchers = []
+    for matcher in matchers:
+        if matcher['literal'] is not None:
+            count_literal(block,block_pos,matcher,seek_counts,start_pos_dict[matcher['seek_str']],recorder)
+        else:
+            regex_matchers.append(matcher)
+
+    text_matchers = regex_matchers
+    if block.isascii():
+        bytes_matchers = [matcher for matcher in regex_matchers if matcher['seek_bytes_re'] is not None]
+        text_matchers = [matcher for matcher in regex_matchers if matcher['seek_bytes_re'] is None]
+        any_matchers = [matcher for matcher in bytes_matchers if any_re is not None and matcher['in_any_re']]
+        if any_matchers:
+            count_regex(block,block_pos,any_matchers,seek_counts,start_pos_dict,any_re,recorder)
+        for matcher in bytes_matchers:
+            if matcher not in any_matchers:
+                count_regex(block,block_pos,[matcher],seek_counts,start_pos_dict,matcher['seek_bytes_re'],recorder)
+
+    if not text_matchers:
+        return
+    # surrogateescape keeps invalid bytes, so the byte offsets of the lines can be counted back
+    text = block.decode('utf-8','surrogateescape')
+    for matcher in text_matchers:
+        count_regex_text(text,block_pos,matcher,seek_counts,start_pos_dict[matcher['seek_str']],recorder)
+
+def scan_log(seek_f,matchers,seek_counts,start_pos_dict,any_re=None,scan_pos=None,stop_pos=None,recorder=None):
+    """Count the complete lines after each pattern's start position, return the offset after the last one."""
+
+    if scan_pos is None:
+        scan_pos = min(start_pos_dict[matcher['seek_str']] for matcher in matchers)
+    for block,end_pos in read_blocks(seek_f,scan_pos,stop_pos):
+        count_block(block,scan_pos,matchers,seek_counts,start_pos_dict,any_re,recorder)
+        scan_pos = end_pos
+
+    return scan_pos
+
+def split_range(seek_f,start_pos,stop_pos,chunks):
+    """Split start_pos..stop_pos into about the given number of ranges, each ending right after a line break."""
+
+    bounds = [start_pos]
+    step = max((stop_pos - start_pos) // chunks,CHUNK_SIZE)
+    pos = start_pos + step
+    while pos < stop_pos:
+        seek_f.seek(pos,0)
+        seek_f.readline()
+        pos = seek_f.tell()
+        if pos >= stop_pos:
+            break
+        bounds.append(pos)
+        pos = pos + step
+    bounds.append(stop_pos)
+
+    return list(zip(bounds[:-1],bounds[1:]))
+
+def scan_range(args):
+    """Count one range of a log in a worker process."""
+
+    file_path,patterns,start_pos_dict,range_start,range_stop,recorder = args
+
+    matchers,any_re = compile_matchers(patterns)
+    seek_counts = dict((pattern['name'],0) for pattern in patterns)
+    with open(file_path,'rb') as seek_f:
+        end_pos = scan_log(seek_f,matchers,seek_counts,start_pos_dict,any_re,range_start,range_stop,recorder)
 
+    return seek_counts,end_pos,recorder
+
+def scan_log_parallel(file_path,patterns,seek_counts,start_pos_dict,stop_pos,parallel,recorder=None):
+    """Count the log in line-aligned ranges in a process pool, return the offset after the last complete line."""
+
+    import multiprocessing
+
+    scan_pos = min(start_pos_dict.values())
+    with open(file_path,'rb') as seek_f:
+        # a few ranges per process, so a slow range doesn't leave the other processes idle
+        ranges = split_range(seek_f,scan_pos,stop_pos,parallel * 4)
+
+    pool = multiprocessing.Pool(parallel)
+    try:
+        # any failed range raises here, before the checkpoint is saved
+        # each range gets an empty copy of the recorder, merged back in file order
+        range_recorder = None
+        if recorder is not None:
+            range_recorder = new_recorder(patterns,recorder['histogram'],recorder['samples'])
+            range_recorder['log_path'] = file_path
+        results = pool.map(scan_range,[(file_path,patterns,start_pos_dict,range_start,range_stop,range_recorder)
+                                       for range_start,range_stop in ranges])
+    finally:
+        pool.terminate()
+        pool.join()
+
+    for range_counts,end_pos,range_recorder in results:
+        for name,count in range_counts.items():
+            seek_counts[name] = seek_counts[name] + count
+        if recorder is not None:
+            merge_recorder(recorder,range_recorder)
+
+    return results[-1][1]
+
+def scan_seek_counts(file_path,patterns,seek_entries,parallel=0,compiled=None,recorder=None):
+    """Count every pattern in a single pass over the bytes not yet read by any of them.
+
+    If the log was rotated since the last run, the rest of the rotated file is
+    counted from the old offset first, then the new file from the beginning.
+    With parallel, a huge backlog of the current file is split between that
+    many processes. Returns the counts and the new checkpoint entries.
+    """
+
+    seek_strs = [pattern['seek_str'] for pattern in patterns]
+    matchers,any_re = compiled or compile_matchers(patterns)
+    seek_counts = dict((pattern['name'],0) for pattern in patterns)
+
+    seek_f = open_log(file_path)
+    try:
+        identity = get_identity(file_path,seek_f)
+
+        start_pos_dict = {}
+        rotated_dict = {}
+        for seek_str,entry in seek_entries.items():
+            if is_same_log(entry,identity):
+                start_pos_dict[seek_str] = entry['pos']
+                continue
+            start_pos_dict[seek_str] = 0
+            # compressed logs are not written to, so they are not followed through rotation
+            if 'inode' in entry and not is_compressed(file_path):
+                rotated_path = find_rotated_log(file_path,entry)
+                if rotated_path is not None:
+                    rotated_dict.setdefault(rotated_path,{})[seek_str] = entry['pos']
+
+        for rotated_path,rotated_pos_dict in rotated_dict.items():
+            rotated_matchers = [matcher for matcher in matchers if matcher['seek_str'] in rotated_pos_dict]
+            if recorder is not None:
+                recorder['log_path'] = rotated_path
+            with open_log(rotated_path) as rotated_f:
+                scan_log(rotated_f,rotated_matchers,seek_counts,rotated_pos_dict,any_re,recorder=recorder)
+
+        if is_compressed(file_path):
+            # a decompressing stream can't seek back over the head
+            seek_f.close()
+            seek_f = open_log(file_path)
+
+        if recorder is not None:
+            recorder['log_path'] = file_path
+
+        # only complete lines are counted, a partial last line is left for the next run
+        if parallel > 1 and identity['size'] is not None and identity['size'] - min(start_pos_dict.values()) >= PARALLEL_MIN_SIZE:
+            scan_pos = scan_log_parallel(file_path,patterns,seek_counts,start_pos_dict,identity['size'],parallel,recorder)
+        else:
+            scan_pos = scan_log(seek_f,matchers,seek_counts,start_pos_dict,any_re,recorder=recorder)
+    finally:
+        seek_f.close()
+
+    new_entries = {}
+    for seek_str in seek_strs:
+        new_entries[seek_str] = {'pos':max(start_pos_dict[seek_str],scan_pos), 'dev':identity['dev'],
+                                 'inode':identity['inode'], 'head':identity['head'], 'head_len':identity['head_len'],
+                                 'file_size':identity['file_size'], 'mtime':identity['mtime']}
+
+    return seek_counts,new_entries
+
+def expand_log_paths(file_path):
+    """Expand a glob or a directory to the files in it, each one keeps its own checkpoints.
+
+    The rotated files of a log that is also matched are left out, the rest of
+    them is already counted through the checkpoints of the live log, and they
+    would be counted again from the beginning under their own names.
+    """
+
+    if os.path.isdir(file_path):
+        paths = [os.path.join(file_path,name) for name in os.listdir(file_path)]
+    elif any(c in file_path for c in '*?['):
+        paths = glob.glob(file_path)
+    else:
+        return [file_path]
+    paths = set(path for path in paths if os.path.isfile(path))
+    return sorted(path for path in paths if not is_rotated_log(path,paths))
+
+def is_rotated_log(path,paths):
+    """Whether a file is a rotated file (.1, .2.gz, dateext) of one of the paths."""
+
+    m = ROTATED_SUFFIX_RE.search(path)
+    return m is not None and path[:m.start()] in paths
+
+def is_unchanged(log_path,seek_entries):
+    """Whether a log has the same inode, size and mtime as at its last checkpoint, checked without opening it."""
+
+    try:
+        f_stat = os.stat(log_path)
+    except OSError:
+        return False
+    for entry in seek_entries.values():
+        if entry.get('mtime') is None:
+            return False
+        if (entry['dev'],entry['inode'],entry['file_size'],entry['mtime']) != (f_stat.st_dev,f_stat.st_ino,f_stat.st_size,f_stat.st_mtime_ns):
+            return False
+
+    return True
+
+def get_checks_seek_counts(checks,parallel=0,threads=1):
+    """Count the patterns of every check, each a dict of file_path, patterns and an optional recorder.
+
+    Each log is read once for all the patterns of its check, and all the
+    checkpoints are read and saved in one go. A glob or directory file_path is
+    counted in total over the logs it matches, the count of each log is kept
+    in the check's file_counts. Logs unchanged since their checkpoint are
+    skipped without being opened, the others are scanned in a pool of threads,
+    parallel only applies when they are scanned one after another.
+    """
+
+    seek_strs_dict = {}
+    for check in checks:
+        check['log_paths'] = expand_log_paths(check['file_path'])
+        for log_path in check['log_paths']:
+            seek_strs_dict.setdefault(log_path,[]).extend(pattern['seek_str'] for pattern in check['patterns'])
+    all_entries = get_all_seek_entries(seek_strs_dict)
+
+    tasks = []
+    for check in checks:
+        check['compiled'] = compile_matchers(check['patterns'])
+        seek_strs = [pattern['seek_str'] for pattern in check['patterns']]
+        for log_path in check['log_paths']:
+            seek_entries = dict((seek_str,all_entries[log_path][seek_str]) for seek_str in seek_strs)
+            if not is_unchanged(log_path,seek_entries):
+                tasks.append((check,log_path,seek_entries))
+
+    def scan_task(task,task_parallel=parallel):
+        check,log_path,seek_entries = task
+        recorder = check.get('recorder')
+        # each log gets its own recorder, so threads don't share one
+        log_recorder = new_recorder(check['patterns'],recorder['histogram'],recorder['samples']) if recorder is not None else None
+        log_counts,new_entries = scan_seek_counts(log_path,check['patterns'],seek_entries,task_parallel,check['compiled'],log_recorder)
+        return log_counts,new_entries,log_recorder
+
+    if threads > 1 and len(tasks) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        # no process pools in the threads, that would be a pool per thread forked from a multithreaded process
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            task_results = list(executor.map(lambda task: scan_task(task,0),tasks))
+    else:
+        task_results = [scan_task(task) for task in tasks]
+
+    for check in checks:
+        check['file_counts'] = dict((log_path,dict((pattern['name'],0) for pattern in check['patterns'])) for log_path in check['log_paths'])
+
+    new_all_entries = {}
+    for (check,log_path,seek_entries),(log_counts,new_entries,log_recorder) in zip(tasks,task_results):
+        check['file_counts'][log_path] = log_counts
+        new_all_entries.setdefault(log_path,{}).update(new_entries)
+        if log_recorder is not None:
+            merge_recorder(check['recorder'],log_recorder)
+
+    results = []
+    for check in checks:
+        seek_counts = dict((pattern['name'],0) for pattern in check['patterns'])
+        for log_counts in check['file_counts'].values():
+            for name,seek_count in log_counts.items():
+                seek_counts[name] = seek_counts[name] + seek_count
+        results.append(seek_counts)
+
+    save_all_seek_entries(new_all_entries)
+
+    return results
+
+def get_seek_counts(file_path,patterns,parallel=0,recorder=None):
+    """Count the patterns in a log, or in total over every log a glob matches."""
+
+    return get_checks_seek_counts([{'file_path':file_path, 'patterns':patterns, 'recorder':recorder}],parallel)[0]
+
+def get_seek_count(file_path,seek_str,ignore_str=None,parallel=0):
+    patterns = [{'name':seek_str, 'seek_str':seek_str, 'ignore_str':ignore_str}]
+    return get_seek_counts(file_path,patterns,parallel)[seek_str]
+
+def zabbix_quote(value):
+    return '"{0}"'.format(value.replace('\\','\\\\').replace('"','\\"'))
+
+def format_zabbix_lines(file_path,seek_counts,zabbix_host,timestamp):
+    """Format counts as zabbix_sender input lines: <host> <key> <timestamp> <value>."""
+
+    lines = []
+    for name,seek_count in sorted(seek_counts.items()):
+        key = '{0}[{1},{2}]'.format(ZABBIX_KEY,zabbix_quote(file_path),zabbix_quote(name))
+        lines.append('{0} {1} {2} {3}'.format(zabbix_host,zabbix_quote(key),timestamp,seek_count))
+
+    return lines
+
+def format_samples(details):
+    return {'first':details['first'], 'last':list(details['last'])}
+
+def format_details(seek_counts,recorder,with_samples=True):
+    """Format the total count, the per-interval counts and the samples of each pattern as a dict for JSON output."""
+
+    results = {}
+    for name,seek_count in seek_counts.items():
+        details = recorder['names'][name]
+        results[name] = {'total':seek_count}
+        if recorder['histogram']:
+            buckets = details['buckets']
+            results[name]['histogram'] = dict((time.strftime('%Y-%m-%dT%H:%M:%S',time.localtime(bucket)),buckets[bucket]) for bucket in sorted(buckets))
+            results[name]['unparsed'] = details['unparsed']
+        if recorder['samples'] and with_samples:
+            results[name]['samples'] = format_samples(details)
+
+    return results
+
+def save_samples(samples_file,checks,results):
+    """Write the samples of every check to a sidecar JSON file, replacing it atomically."""
+
+    data = {}
+    for check,seek_counts in zip(checks,results):
+        data[check['file_path']] = {}
+        for name,seek_count in seek_counts.items():
+            samples = format_samples(check['recorder']['names'][name])
+            samples['total'] = seek_count
+            data[check['file_path']][name] = samples
+
+    tmp_file = '{0}.{1}.tmp'.format(samples_file,os.getpid())
+    with open(tmp_file,'w') as f:
+        json.dump(data,f,indent=2,sort_keys=True)
+    os.rename(tmp_file,samples_file)
+
+    return True
+
+def format_zabbix_histogram_lines(file_path,seek_counts,recorder,zabbix_host,timestamp):
+    """Format the totals, and every interval count timestamped with the start of its interval, as zabbix_sender lines."""
+
+    lines = format_zabbix_lines(file_path,seek_counts,zabbix_host,timestamp)
+    for name in sorted(seek_counts):
+        key = '{0}.histogram[{1},{2}]'.format(ZABBIX_KEY,zabbix_quote(file_path),zabbix_quote(name))
+        buckets = recorder['names'][name]['buckets']
+        for bucket in sorted(buckets):
+            lines.append('{0} {1} {2} {3}'.format(zabbix_host,zabbix_quote(key),bucket,buckets[bucket]))
+
+    return lines
+
+def send_lines(lines,socket_path=None):
+    if socket_path is None:
+        sys.stdout.write(''.join(line + '\n' for line in lines))
+        sys.stdout.flush()
+        return True
+
+    sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(''.join(line + '\n' for line in lines).encode('utf-8'))
+    except socket.error as e:
+        sys.stderr.write("ERROR: Failed to send counts to '{0}': {1}\n".format(socket_path,e))
+        return False
+    finally:
+        sock.close()
+
+    return True
+
+def follow_logs(checks,opts):
+    """Keep scanning the logs, send the counts every interval and save the checkpoints after each send.
+
+    Each check is a dict of file_path and patterns. The counters and offsets
+    stay in memory between polls, so there is no interpreter start, state
+    read or regex compile per count. The files are polled rather than watched
+    with inotify, which also covers rotation and NFS mounted logs. A glob or
+    directory is expanded again on every poll, so new logs are followed too.
+    """
+
+    def update_logs(check):
+        seek_strs = [pattern['seek_str'] for pattern in check['patterns']]
+        check['log_paths'] = expand_log_paths(check['file_path'])
+        for log_path in check['log_paths']:
+            if log_path not in check['logs']:
+                check['logs'][log_path] = {'seek_entries':get_last_seek_entries(log_path,seek_strs),
+                                           'seek_counts':dict((pattern['name'],0) for pattern in check['patterns'])}
+
+    for check in checks:
+        check['compiled'] = compile_matchers(check['patterns'])
+        check['logs'] = {}
+        update_logs(check)
+
+    def stop(signum,frame):
+        sys.exit(0)
+    signal.signal(signal.SIGTERM,stop)
+
+    def flush():
+        timestamp = int(time.time())
+        lines = []
+        for check in checks:
+            for log_path in sorted(check['logs']):
+                lines.extend(format_zabbix_lines(log_path,check['logs'][log_path]['seek_counts'],opts['zabbix_host'],timestamp))
+        if not send_lines(lines,opts['socket']):
+            # keep the counts and the old checkpoints, and try again next interval
+            return False
+        all_entries = {}
+        for check in checks:
+            for log_path,log in check['logs'].items():
+                all_entries.setdefault(log_path,{}).update(log['seek_entries'])
+        save_all_seek_entries(all_entries)
+        for check in checks:
+            for log_path,log in list(check['logs'].items()):
+                if log_path not in check['log_paths']:
+                    # the log was removed or rotated away, its last counts are sent
+                    del check['logs'][log_path]
+                    continue
+                for name in log['seek_counts']:
+                    log['seek_counts'][name] = 0
+        return True
+
+    next_flush = time.time() + opts['interval']
+    try:
+        while True:
+            for check in checks:
+                update_logs(check)
+                for log_path in check['log_paths']:
+                    log = check['logs'][log_path]
+                    if is_unchanged(log_path,log['seek_entries']):
+                        continue
+                    try:
+                        seek_counts,log['seek_entries'] = scan_seek_counts(log_path,check['patterns'],
+                                                                           log['seek_entries'],opts['parallel'],check['compiled'])
+                    except (IOError,OSError):
+                        # the log is being rotated, or not created yet
+                        continue
+                    for name,seek_count in seek_counts.items():
+                        log['seek_counts'][name] = log['seek_counts'][name] + seek_count
+
+            if time.time() >= next_flush:
+                flush()
+                next_flush = next_flush + opts['interval']
+                while next_flush <= time.time():
+                    next_flush = next_flush + opts['interval']
+
+            time.sleep(opts['poll'])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        flush()
+
+    return 0
+
+def load_checks(config_path):
+    """Load the checks of a config file, grouped by file_path so each file is read once."""
+
+    import yaml
+
+    with open(config_path) as f:
+        config = yaml.safe_load(f) or {}
+
+    checks = []
+    check_dict = {}
+    for item in config.get('checks') or []:
+        if not isinstance(item,dict):
+            sys.stderr.write("ERROR: Every check in '{0}' must be a mapping, got {1!r}\n".format(config_path,item))
+            sys.exit(2)
+        for key in ['file_path','seek_str','name','ignore_str']:
+            # YAML reads an unquoted 404 or yes as a number or a boolean, and 0404 as an octal number
+            if item.get(key) is not None and not isinstance(item[key],str):
+                sys.stderr.write("ERROR: The {0} {1!r} of a check in '{2}' must be a string, quote it\n".format(key,item[key],config_path))
+                sys.exit(2)
+        if not item.get('file_path') or not item.get('seek_str'):
+            sys.stderr.write("ERROR: Every check in '{0}' requires file_path and seek_str\n".format(config_path))
+            sys.exit(2)
+        if item['file_path'] not in check_dict:
+            check_dict[item['file_path']] = {'file_path':item['file_path'], 'patterns':[]}
+            checks.append(check_dict[item['file_path']])
+        pattern = {'name':item.get('name',item['seek_str']), 'seek_str':item['seek_str'], 'ignore_str':item.get('ignore_str')}
+        if pattern['name'] in [other['name'] for other in check_dict[item['file_path']]['patterns']]:
+            # the counts would be added up under the one name
+            sys.stderr.write("ERROR: Duplicate check '{0}' of '{1}' in '{2}', give each one a distinct name\n".format(
+                pattern['name'],item['file_path'],config_path))
+            sys.exit(2)
+        check_dict[item['file_path']]['patterns'].append(pattern)
+
+    return checks
+
+def main():
     opts = parse_opts()
-    seek_count = get_seek_count(opts['file_path'],opts['seek_str'],opts['ignore_str'])
+    if opts['config']:
+        checks = load_checks(opts['config'])
+    else:
+        checks = [{'file_path':opts['file_path'], 'patterns':opts['patterns']}]
+
+    if opts['follow']:
+        return follow_logs(checks,opts)
+
+    if opts['histogram'] or opts['samples']:
+        for check in checks:
+            check['recorder'] = new_recorder(check['patterns'],opts['histogram'],opts['samples'])
+    results = get_checks_seek_counts(checks,opts['parallel'],opts['threads'])
+
+    if opts['samples_file']:
+        save_samples(opts['samples_file'],checks,results)
+
+    if opts['output'] == 'zabbix' and (opts['histogram'] or opts['config']):
+        timestamp = int(time.time())
+        lines = []
+        for check,seek_counts in zip(checks,results):
+            if opts['histogram']:
+                lines.extend(format_zabbix_histogram_lines(check['file_path'],seek_counts,check['recorder'],opts['zabbix_host'],timestamp))
+            else:
+                lines.extend(format_zabbix_lines(check['file_path'],seek_counts,opts['zabbix_host'],timestamp))
+        send_lines(lines)
+        return 0
+
+    with_details = opts['histogram'] or (opts['samples'] and not opts['samples_file'])
+    if with_details:
+        results = [format_details(seek_counts,check['recorder'],not opts['samples_file']) for check,seek_counts in zip(checks,results)]
+    if opts['per_file']:
+        if opts['seek_str'] and not with_details:
+            results = [{'total':seek_counts[opts['seek_str']],
+                        'files':dict((log_path,log_counts[opts['seek_str']]) for log_path,log_counts in check['file_counts'].items())}
+                       for check,seek_counts in zip(checks,results)]
+        else:
+            results = [{'total':result, 'files':check['file_counts']} for check,result in zip(checks,results)]
+        if not opts['config']:
+            print(json.dumps(results[0],sort_keys=True))
+            return 0
+    if opts['config']:
+        print(json.dumps(dict((check['file_path'],result) for check,result in zip(checks,results)),sort_keys=True))
+    elif opts['seek_str'] and not with_details:
+        print(results[0][opts['seek_str']])
+    else:
+        print(json.dumps(results[0],sort_keys=True))
 
-    print(seek_count)
     return 0
 
 if __name__ == '__main__':
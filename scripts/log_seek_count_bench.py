@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+# Benchmark log_seek_count.py on synthetic syslog and nginx logs,
+# with literal and regex patterns, with and without ignore_str
+
+import os
+import re
+import sys
+import json
+import time
+import resource
+import tempfile
+import subprocess
+
+import log_seek_count
+
+# every match_every lines one matching line is written, half of them also match the ignore string
+LOG_STYLES = {
+    'syslog': {
+        'line': "Oct 18 12:{0:02d}:{1:02d} idc1-server1 kernel: [{2}.{3:06d}] eth0: link up, 1000Mbps, full-duplex\n",
+        'match': "Oct 18 12:{0:02d}:{1:02d} idc1-server1 kernel: [{2}.{3:06d}] HANDLING MCE MEMORY ERROR\n",
+        'ignored': "Oct 18 12:{0:02d}:{1:02d} idc1-server2 kernel: [{2}.{3:06d}] HANDLING MCE MEMORY ERROR\n",
+        'literal': "HANDLING MCE MEMORY ERROR",
+        'regex': "kernel:\\s\\[[\\d\\.]+\\]\\sHANDLING MCE",
+        'ignore_str': "idc1-server2",
+    },
+    'nginx': {
+        'line': '10.0.{0}.{1} - - [18/Oct/2026:12:{0:02d}:{1:02d} +0000] "GET /static/app.{2}.js HTTP/1.1" 200 {3} "-" "Mozilla/5.0"\n',
+        'match': '10.0.{0}.{1} - - [18/Oct/2026:12:{0:02d}:{1:02d} +0000] "GET /api/orders/{2} HTTP/1.1" 502 {3} "-" "Mozilla/5.0"\n',
+        'ignored': '10.0.{0}.{1} - - [18/Oct/2026:12:{0:02d}:{1:02d} +0000] "GET /healthz?{2} HTTP/1.1" 502 {3} "-" "Mozilla/5.0"\n',
+        'literal': '" 502 ',
+        'regex': '" 5\\d\\d \\d+ ',
+        'ignore_str': "/healthz",
+    },
+}
+
+def parse_opts():
+    """Help messages(-h, --help)."""
+
+    import textwrap
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent(
+        '''
+        examples:
+          {0}
+          {0} --size_mb 100 --match_every 1000 --style syslog
+          {0} --size_mb 100 --old --save before.json
+          {0} --size_mb 100 --save after.json --compare before.json
+          {0} --size_mb 4096 --parallel 8
+        '''.format(__file__)
+        ))
+
+    parser.add_argument('--size_mb', type=int, default=1024, help='size of each synthetic log [default: 1024]')
+    parser.add_argument('--match_every', type=int, default=10000, help='one matching line every N lines [default: 10000]')
+    parser.add_argument('--style', type=str, action='append', choices=sorted(LOG_STYLES), help='log style to generate, can be repeated [default: all]')
+    parser.add_argument('--runs', type=int, default=3, help='runs of each case, the latency of every run is reported [default: 3]')
+    parser.add_argument('--old', action="store_true", default=False, help='also time the old line by line regex scan')
+    parser.add_argument('--parallel', type=int, default=0, help='also time the parallel scan with 2, 4, ... up to N processes')
+    parser.add_argument('--save', type=str, help='save the results as JSON to this file')
+    parser.add_argument('--compare', type=str, help='compare the MB/s with the results saved in this file')
+    parser.add_argument('--tmp_dir', type=str, help='directory for the synthetic logs [default: system temp dir]')
+    parser.add_argument('--run_case', type=str, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    return {'size_mb':args.size_mb, 'match_every':args.match_every, 'styles':args.style or sorted(LOG_STYLES), 'runs':args.runs,
+            'old':args.old, 'parallel':args.parallel, 'save':args.save, 'compare':args.compare, 'tmp_dir':args.tmp_dir,
+            'run_case':args.run_case}
+
+def generate_log(file_path,style,size_mb,match_every):
+    """Write a log of about size_mb in the given style with one matching line every match_every lines."""
+
+    templates = LOG_STYLES[style]
+    size = size_mb * 1024 * 1024
+    written = 0
+    n = 0
+    with open(file_path,'w') as f:
+        while written < size:
+            lines = []
+            for i in range(1000):
+                n = n + 1
+                if n % match_every != 0:
+                    template = templates['line']
+                elif n // match_every % 2 == 0:
+                    template = templates['match']
+                else:
+                    template = templates['ignored']
+                lines.append(template.format(n // 60 % 60,n % 60,n // 1000,n % 1000000))
+            data = ''.join(lines)
+            f.write(data)
+            written = written + len(data)
+
+    return written
+
+def old_seek_count(file_path,seek_str,ignore_str=None):
+    """The previous implementation: decode every line and run re.search on it."""
+
+    seek_count = 0
+    with open(file_path,'r') as seek_f:
+        for line in seek_f:
+            if re.search(seek_str,line) and (ignore_str is None or not re.search(ignore_str,line)):
+                seek_count = seek_count + 1
+
+    return seek_count
+
+def run_case(case):
+    """Run one case in this process and report its count, latency and peak RSS."""
+
+    log_seek_count.SEEK_DB = case['seek_db']
+    log_seek_count.YAML_DATA = case['seek_db'] + '.yml'
+    # the benchmark file may be smaller than a real backlog, always use the pool
+    log_seek_count.PARALLEL_MIN_SIZE = 0
+
+    # start from an empty state, so the run scans the whole file
+    if os.path.exists(case['seek_db']):
+        os.remove(case['seek_db'])
+
+    start_timestamp = time.time()
+    if case['engine'] == 'old':
+        count = old_seek_count(case['file_path'],case['seek_str'],case['ignore_str'])
+    else:
+        count = log_seek_count.get_seek_count(case['file_path'],case['seek_str'],case['ignore_str'],case['parallel'])
+    secs = time.time() - start_timestamp
+
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if case['parallel'] > 1:
+        peak_rss_kb = max(peak_rss_kb,resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    return {'count':count, 'secs':secs, 'peak_rss_kb':peak_rss_kb}
+
+def run_case_process(case):
+    """Run one case in a fresh interpreter, so its peak RSS is its own."""
+
+    output = subprocess.check_output([sys.executable,os.path.abspath(__file__),'--run_case',json.dumps(case)])
+    return json.loads(output.decode('utf-8'))
+
+def check_rotation(tmp_dir):
+    """Count a directory across a rotation, the rotated file must not be counted again under its own name."""
+
+    log_seek_count.SEEK_DB = os.path.join(tmp_dir,'rotation_seek_pos.db')
+    log_seek_count.YAML_DATA = log_seek_count.SEEK_DB + '.yml'
+    log_dir = os.path.join(tmp_dir,'rotation')
+    os.mkdir(log_dir)
+    file_path = os.path.join(log_dir,'app.log')
+
+    def write_lines(lines):
+        with open(file_path,'a') as f:
+            f.write(''.join("ERROR {0}\n".format(line) for line in lines))
+
+    try:
+        write_lines([1,2])
+        counts = [log_seek_count.get_seek_count(log_dir,'ERROR')]
+        write_lines([3])
+        os.rename(file_path,file_path + '.1')
+        write_lines([4])
+        counts.append(log_seek_count.get_seek_count(log_dir,'ERROR'))
+    finally:
+        for name in os.listdir(log_dir):
+            os.remove(os.path.join(log_dir,name))
+        os.rmdir(log_dir)
+        os.remove(log_seek_count.SEEK_DB)
+
+    return counts == [2,2]
+
+def get_cases(style,file_path,seek_db,opts):
+    templates = LOG_STYLES[style]
+    engines = [('old',0)] if opts['old'] else []
+    engines.append(('new',0))
+    parallel = 2
+    while parallel <= opts['parallel']:
+        engines.append(('new',parallel))
+        parallel = parallel * 2
+
+    cases = []
+    for engine,parallel in engines:
+        for kind in ['literal','regex']:
+            for ignore_str in [None,templates['ignore_str']]:
+                name = "{0}/{1}{2}".format(style,kind," + ignore_str" if ignore_str else "")
+                name = "{0} {1}".format(name,engine if not parallel else "parallel {0}".format(parallel))
+                cases.append({'name':name, 'style':style, 'kind':kind, 'engine':engine, 'parallel':parallel,
+                              'file_path':file_path, 'seek_db':seek_db, 'seek_str':templates[kind], 'ignore_str':ignore_str})
+
+    return cases
+
+def main():
+    opts = parse_opts()
+
+    if opts['run_case']:
+        print(json.dumps(run_case(json.loads(opts['run_case']))))
+        return 0
+
+    previous = {}
+    if opts['compare']:
+        with open(opts['compare']) as f:
+            previous = dict((result['name'],result) for result in json.load(f)['results'])
+
+    tmp_dir = tempfile.mkdtemp(dir=opts['tmp_dir'])
+    seek_db = os.path.join(tmp_dir,'logs_seek_pos.db')
+
+    results = []
+    try:
+        if not check_rotation(tmp_dir):
+            print("ERROR: a rotated log was counted twice")
+            return 1
+
+        for style in opts['styles']:
+            file_path = os.path.join(tmp_dir,'{0}.log'.format(style))
+            print("Generating {0}MB {1} log in {2}...".format(opts['size_mb'],style,file_path))
+            size_mb = generate_log(file_path,style,opts['size_mb'],opts['match_every']) / 1024.0 / 1024.0
+
+            for case in get_cases(style,file_path,seek_db,opts):
+                runs = [run_case_process(case) for i in range(opts['runs'])]
+                latencies = sorted(run['secs'] for run in runs)
+                result = {'name':case['name'], 'style':style, 'kind':case['kind'], 'engine':case['engine'],
+                          'parallel':case['parallel'], 'seek_str':case['seek_str'], 'ignore_str':case['ignore_str'],
+                          'size_mb':size_mb, 'count':runs[0]['count'], 'latency_secs':[run['secs'] for run in runs],
+                          'mb_per_sec':size_mb / latencies[len(latencies) // 2],
+                          'peak_rss_kb':max(run['peak_rss_kb'] for run in runs)}
+                results.append(result)
+
+                line = "  {0:<40} {1:>8} lines  {2:>8.1f}MB/s  p50 {3:.3f}s  max {4:.3f}s  peak RSS {5}KB".format(
+                    result['name'],result['count'],result['mb_per_sec'],latencies[len(latencies) // 2],latencies[-1],result['peak_rss_kb'])
+                if result['name'] in previous:
+                    line = "{0}  {1:+.1f}%".format(line,(result['mb_per_sec'] / previous[result['name']]['mb_per_sec'] - 1) * 100)
+                print(line)
+
+            counts = set(result['count'] for result in results if result['style'] == style and result['ignore_str'] is None)
+            ignored_counts = set(result['count'] for result in results if result['style'] == style and result['ignore_str'] is not None)
+            if len(counts) != 1 or len(ignored_counts) != 1:
+                print("ERROR: counts of the {0} cases differ".format(style))
+                return 1
+            os.remove(file_path)
+    finally:
+        for name in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir,name))
+        os.rmdir(tmp_dir)
+
+    if opts['save']:
+        data = {'date':time.strftime('%Y-%m-%d %H:%M:%S'), 'python':sys.version.split()[0], 'size_mb':opts['size_mb'],
+                'match_every':opts['match_every'], 'runs':opts['runs'], 'chunk_size':log_seek_count.CHUNK_SIZE, 'results':results}
+        with open(opts['save'],'w') as f:
+            json.dump(data,f,indent=2,sort_keys=True)
+        print("Saved results to {0}".format(opts['save']))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,10 +2,22 @@
 # Author: Dong Guo
 
 import sys
-import requests
+import os
+import json
 import time
 import argparse
 import textwrap
+import threading
+
+CHUNK_SIZE = 64 * 1024
+MAX_BYTES = 10 * 1024 * 1024
+CACHE_TTL = 5
+MAX_REDIRECTS = 30
+USER_AGENT = 'zcurl'
+# requests honors these, http.client does not, so a plain check falls back to requests when one is set
+PROXY_ENV = ['http_proxy', 'https_proxy', 'all_proxy', 'HTTP_PROXY', 'HTTPS_PROXY', 'ALL_PROXY']
+# the CA bundles requests verifies with, before its own
+CA_BUNDLE_ENV = ['REQUESTS_CA_BUNDLE', 'CURL_CA_BUNDLE']
 
 def parse_opts():
     """Help messages(-h, --help)."""
@@ -20,18 +32,49 @@ def parse_opts():
           {0} -u http://idc1-web1/health -c ok
           {0} -u http://idc1-web1/health -c ok -V
           {0} -u http://idc1-web1/health -c ok -t 2 -V
+          {0} -u http://idc1-web1/big_page -c ok -m 65536
+          {0} -u http://idc1-web1/big_page -c ok -T json
+          {0} -u http://idc1-web1/health --samples 20 --interval 100
+          {0} -u http://idc1-web1/health -c ok --samples 20 --interval 100 -T zabbix | zabbix_sender -c /etc/zabbix/zabbix_agentd.conf -i -
           {0} -u http://idc1-web2:3000
           {0} -u http://idc1-web3/login.php?page=redirect_string -a username:password -V
           {0} -u https://idc2-web1.yourdomain.com -V
+          {0} -u https://idc2-web1.yourdomain.com -T json
+          {0} -u https://idc2-web1.yourdomain.com -T zabbix | zabbix_sender -c /etc/zabbix/zabbix_agentd.conf -i -
+          {0} -u https://idc2-web1.yourdomain.com -c ok -x json
+          {0} -u https://idc2-web1.yourdomain.com -T json -x json
+          {0} -d /run/zabbix/zcurl.sock -C 5 -w 32
+          {0} -u http://idc1-web1/health -c ok -V -S /run/zabbix/zcurl.sock
+          {0} -b /etc/zabbix/zcurl_checks.jsonl -w 32 | zabbix_sender -c /etc/zabbix/zabbix_agentd.conf -i -
+
+          /etc/zabbix/zcurl_checks.jsonl, one check per line, keys as the metavars of the flags: url, content, auth,
+          payload, timeout and max_bytes, value for -V and tls for -x as true, key and host of the zabbix_sender line:
+          {{"url": "http://idc1-web1/health", "content": "ok"}}
+          {{"url": "http://idc1-web1/health", "content": "ok", "value": true, "key": "web1.health.body"}}
+          {{"url": "http://idc1-web3/login.php", "auth": "username:password", "payload": "page=redirect_string", "timeout": 2}}
+          {{"url": "https://idc2-web1.yourdomain.com", "tls": true}}
         '''.format(__file__)
         ))
 
-    parser.add_argument('-u', metavar='url', type=str, required=True, help='URL to GET or POST [default: http://]')
+    parser.add_argument('-u', metavar='url', type=str, help='URL to GET or POST [default: http://]')
     parser.add_argument('-t', metavar='timeout', type=float, help='seconds before connection times out [default: 10]')
     parser.add_argument('-c', metavar='content', type=str, help='string to expect in the content')
     parser.add_argument('-a', metavar='auth', type=str, help='username:password on sites with basic authentication')
+    parser.add_argument('-m', metavar='max_bytes', type=int, default=MAX_BYTES, help=f'bytes of the content to read at most, 0 for no limit [default: {MAX_BYTES}]')
+    parser.add_argument('-R', action="store_true", default=False, help='send a plain check with requests instead of http.client')
     parser.add_argument('-V', action="store_true", default=False, help='return actual value instead of 0 and 1')
     parser.add_argument('-p', metavar='payload', type=str, help='URL encoded http POST data')
+    parser.add_argument('-T', metavar='timing', type=str, choices=['json', 'zabbix'], help='report the time of each phase of the request, or the summary of --samples, as json or zabbix_sender lines')
+    parser.add_argument('-x', metavar='tls', type=str, choices=['json', 'zabbix'], help='also report the certificate days to expiry, protocol and cipher of the TLS handshake, as json or zabbix_sender lines, also for a certificate that fails verification')
+    parser.add_argument('-s', '--samples', metavar='samples', type=int, help='send N probes over one pooled connection and report min/p50/p95/p99/max latency and error rate')
+    parser.add_argument('-i', '--interval', metavar='interval', type=int, default=0, help='milliseconds between the probes of --samples [default: 0]')
+    parser.add_argument('-b', metavar='batch', type=str, help='file of JSON checks, one per line, to run concurrently, - for stdin')
+    parser.add_argument('-w', metavar='workers', type=int, default=16, help='concurrent checks and pooled connections per host in batch mode [default: 16]')
+    parser.add_argument('-H', metavar='host', type=str, default='-', help='host name in the zabbix_sender lines of batch and timing mode [default: -, the agent hostname]')
+
+    parser.add_argument('-d', metavar='daemon', type=str, help='run as a daemon answering checks on this unix socket')
+    parser.add_argument('-C', metavar='cache_ttl', type=float, default=CACHE_TTL, help=f'seconds the daemon reuses the response of the same url, method, payload and auth [default: {CACHE_TTL}]')
+    parser.add_argument('-S', metavar='socket', type=str, help='send the check to the daemon on this unix socket, run it here if the daemon is down')
 
     if len(sys.argv) < 2:
         parser.print_help()
@@ -39,78 +82,823 @@ def parse_opts():
 
     args = parser.parse_args()
 
+    if not args.u and not args.b and not args.d:
+        print("Either -u url, -b batch or -d daemon is required")
+        sys.exit(2)
+
+    if args.w < 1:
+        print("Invalid workers. Expected a positive number")
+        sys.exit(2)
+
+    if args.samples is not None and args.samples < 1:
+        print("Invalid samples. Expected a positive number")
+        sys.exit(2)
+
+    if args.interval < 0:
+        print("Invalid interval. Expected 0 or a positive number")
+        sys.exit(2)
+
+    if args.m < 0:
+        print("Invalid max_bytes. Expected 0 or a positive number")
+        sys.exit(2)
+
     if args.a:
         if ':' not in args.a or len(args.a.split(':')) != 2:
             print("Invalid auth format. Expected username:password")
             sys.exit(2)
 
-    return {'url': args.u, 'timeout': args.t, 'content': args.c, 'auth': args.a, 'value': args.V, 'payload': args.p}
+    return {'url': args.u, 'timeout': args.t, 'content': args.c, 'max_bytes': args.m, 'auth': args.a, 'value': args.V, 'payload': args.p, 'requests': args.R,
+            'timing': args.T, 'tls': args.x, 'samples': args.samples, 'interval': args.interval, 'batch': args.b, 'workers': args.w, 'host': args.H,
+            'daemon': args.d, 'cache_ttl': args.C, 'socket': args.S}
 
-def get_results(opts):
-    """Get results with given parameters."""
+def read_content(chunks, content, max_bytes, keep_body=False):
+    """Read the content chunk by chunk up to max_bytes, stopping at the first match unless the body is kept.
+
+    Returns the monotonic time of the match or None, the bytes read and the kept body.
+    """
+
+    needle = content.encode('utf-8')
+    body = []
+    bytes_read = 0
+    match_timestamp = None
+    tail = b''
+    for chunk in chunks:
+        if max_bytes and bytes_read + len(chunk) > max_bytes:
+            chunk = chunk[:max_bytes - bytes_read]
+        bytes_read += len(chunk)
+        if keep_body:
+            body.append(chunk)
+
+        # the end of the previous chunk joined with the start of this one finds a match across the boundary
+        if match_timestamp is None and (needle in chunk or needle in tail + chunk[:len(needle) - 1]):
+            match_timestamp = time.monotonic()
+            if not keep_body:
+                break
+        tail = (tail + chunk)[-(len(needle) - 1):] if len(needle) > 1 else b''
+
+        if max_bytes and bytes_read >= max_bytes:
+            break
+
+    return match_timestamp, bytes_read, b''.join(body)
+
+def drain_content(chunks, max_bytes, bytes_read):
+    """Read the rest of the content left by read_content, so the connection can go back to the pool.
+
+    A body that is longer than max_bytes is left unread and its connection is closed.
+    """
+
+    for chunk in chunks:
+        bytes_read += len(chunk)
+        if max_bytes and bytes_read >= max_bytes:
+            break
+
+def get_url(opts):
+    """Get the URL of a check, http:// by default."""
 
     url = opts['url']
     if "http://" not in url and "https://" not in url:
         url = "http://" + url
+    return url
+
+def requote(uri):
+    """Quote the characters of a URI that are not allowed in a request line, as requests.utils.requote_uri does."""
+
+    from urllib.parse import quote
+
+    unreserved = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~'
+    parts = uri.split('%')
+    for i in range(1, len(parts)):
+        h = parts[i][0:2]
+        if len(h) == 2 and h.isalnum():
+            try:
+                c = chr(int(h, 16))
+            except ValueError:
+                # not an escape, so a % that is quoted as well
+                return quote(uri, safe="!#$&'()*+,/:;=?@[]~")
+            parts[i] = c + parts[i][2:] if c in unreserved else '%' + parts[i]
+        else:
+            parts[i] = '%' + parts[i]
+    return quote(''.join(parts), safe="!#$%&'()*+,/:;=?@[]~")
+
+def get_path(parts):
+    """Get the path and query to request of a split URL, quoted as requests sends them."""
+
+    path = parts.path or '/'
+    if parts.query:
+        path = f"{path}?{parts.query}"
+    return requote(path)
+
+def get_headers(opts):
+    """Get the headers http.client sends for a check, the ones requests would send."""
+
+    import base64
+
+    headers = {'User-Agent': USER_AGENT, 'Accept': '*/*'}
+    if opts.get('auth'):
+        headers['Authorization'] = "Basic " + base64.b64encode(opts['auth'].encode('utf-8')).decode('ascii')
+    return headers
+
+def use_requests(opts):
+    """Whether a plain check needs requests, which costs most of the startup time to import."""
+
+    return opts.get('requests') or any(os.environ.get(name) for name in PROXY_ENV)
+
+def get_ssl_context():
+    """Get an SSL context verifying with the CA bundle requests would use."""
+
+    import ssl
+
+    for name in CA_BUNDLE_ENV:
+        if os.environ.get(name):
+            return ssl.create_default_context(cafile=os.environ[name])
+    try:
+        import certifi
+        return ssl.create_default_context(cafile=certifi.where())
+    except ImportError:
+        return ssl.create_default_context()
+
+def get_tls_info(sock):
+    """Get the certificate days to expiry, protocol and cipher of a TLS socket."""
+
+    import ssl
+
+    if not isinstance(sock, ssl.SSLSocket):
+        return {'cert_days': None, 'tls_version': None, 'tls_cipher': None}
+    cert = sock.getpeercert()
+    cert_days = None
+    if cert and cert.get('notAfter'):
+        cert_days = int((ssl.cert_time_to_seconds(cert['notAfter']) - time.time()) // 86400)
+    return {'cert_days': cert_days, 'tls_version': sock.version(), 'tls_cipher': sock.cipher()[0]}
+
+def read_der(data, pos):
+    """Read the tag, and the start and end of the content, of the DER element at pos."""
+
+    tag = data[pos]
+    length = data[pos + 1]
+    pos = pos + 2
+    if length & 0x80:
+        size = length & 0x7f
+        length = int.from_bytes(data[pos:pos + size], 'big')
+        pos = pos + size
+    return tag, pos, pos + length
+
+def get_cert_expiry(der):
+    """Get the notAfter of a DER certificate as epoch seconds, getpeercert only parses verified ones."""
+
+    import calendar
+
+    _, start, _ = read_der(der, 0)
+    _, start, _ = read_der(der, start)
+    # the fields of tbsCertificate: an optional [0] version, serialNumber, signature, issuer, then validity
+    tag, start, end = read_der(der, start)
+    if tag == 0xa0:
+        tag, start, end = read_der(der, end)
+    for i in range(3):
+        tag, start, end = read_der(der, end)
+    _, _, not_before_end = read_der(der, start)
+    tag, start, end = read_der(der, not_before_end)
+    value = der[start:end].decode('ascii')
+    # UTCTime has a two digit year, GeneralizedTime a four digit one
+    return calendar.timegm(time.strptime(value, '%y%m%d%H%M%SZ' if tag == 0x17 else '%Y%m%d%H%M%SZ'))
+
+def get_unverified_tls_info(host, port, timeout):
+    """Get the TLS details of a server whose certificate failed verification, with a handshake that does not verify it.
 
-    start_timestamp = time.time()
+    Only used to report an expired or otherwise invalid certificate, the check itself still fails.
+    """
+
+    import ssl
+    import socket
+
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    with socket.create_connection((host, port or 443), timeout=timeout) as sock:
+        with context.wrap_socket(sock, server_hostname=host) as ssl_sock:
+            cert_days = int((get_cert_expiry(ssl_sock.getpeercert(binary_form=True)) - time.time()) // 86400)
+            return {'cert_days': cert_days, 'tls_version': ssl_sock.version(), 'tls_cipher': ssl_sock.cipher()[0]}
+
+def add_unverified_tls_info(tls, host, port, timeout):
+    """Put the TLS details of a failed verification in tls, leaving it as it is if the fallback fails too."""
+
+    try:
+        tls.update(get_unverified_tls_info(host, port, timeout))
+    except (OSError, ValueError, IndexError):
+        pass
+
+def print_tls_info(host, url, tls):
+    """Print the TLS details of a check as zabbix_sender lines."""
+
+    for name, value in tls.items():
+        if value is not None:
+            key = f"zcurl.tls[{url},{name}]"
+            print(f"{zabbix_quote(host)} {zabbix_quote(key)} {zabbix_quote(value)}")
+
+def fast_request(opts, timeout, tls=None):
+    """Send the GET or POST of a check with http.client, following redirects as requests does.
+
+    Returns the response, with the body still to be read, and its connection to close.
+    The TLS details of the last connection are put in tls, if given.
+    """
+
+    import ssl
+    import http.client
+    from urllib.parse import urlsplit, urljoin
+
+    url = get_url(opts)
+    method = 'POST' if opts.get('payload') else 'GET'
+    payload = opts.get('payload')
+    auth_host = urlsplit(url).hostname
+
+    for i in range(MAX_REDIRECTS + 1):
+        parts = urlsplit(url)
+        if parts.scheme == 'https':
+            conn = http.client.HTTPSConnection(parts.hostname, parts.port, timeout=timeout, context=get_ssl_context())
+        else:
+            conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=timeout)
+
+        # like requests, drop the credentials once redirected to another host
+        headers = get_headers(opts if parts.hostname == auth_host else {})
+        try:
+            conn.request(method, get_path(parts), body=payload, headers=headers)
+            # taken before the response, which closes the socket of a connection that is not kept alive
+            if tls is not None:
+                tls.update(get_tls_info(conn.sock))
+            resp = conn.getresponse()
+        except Exception as e:
+            conn.close()
+            if tls is not None and isinstance(e, ssl.SSLCertVerificationError):
+                add_unverified_tls_info(tls, parts.hostname, parts.port, timeout)
+            raise
+
+        location = resp.getheader('Location')
+        if resp.status not in (301, 302, 303, 307, 308) or not location:
+            return resp, conn
+
+        resp.read()
+        conn.close()
+        url = urljoin(url, location)
+        if resp.status in (301, 302, 303):
+            method = 'GET'
+            payload = None
+
+    raise ValueError(f"Exceeded {MAX_REDIRECTS} redirects.")
+
+def get_fast_value(opts, tls=None):
+    """Get the value to report and the exit code with given parameters, without importing requests."""
+
+    import socket
+    import http.client
+
+    start_timestamp = time.monotonic()
+    timeout = opts.get('timeout') or 10
+    try:
+        resp, conn = fast_request(opts, timeout, tls)
+        try:
+            if opts.get('content'):
+                match_timestamp, bytes_read, body = read_content(iter(lambda: resp.read(CHUNK_SIZE), b''), opts['content'],
+                                                                 opts.get('max_bytes', MAX_BYTES), opts.get('value'))
+            else:
+                resp.read()
+        finally:
+            conn.close()
+
+        end_timestamp = time.monotonic()
+        response_secs = round(end_timestamp - start_timestamp, 3)
+
+        return check_response(opts, resp.status, response_secs, match_timestamp is not None if opts.get('content') else None,
+                              body if opts.get('content') else None)
+
+    except socket.timeout:
+        return ("Timeout" if opts.get('value') else 1), 0
+
+    except (OSError, http.client.HTTPException):
+        return ("ConnectionError" if opts.get('value') else 1), 0
+
+    except Exception as e:
+        return (f"Unexpected error: {str(e)}" if opts.get('value') else 1), 2
+
+def send_request(http, opts, timeout):
+    """Send the GET or POST of a check and return the response, with the body still to be streamed."""
+
+    httpauth = None
+    if opts.get('auth'):
+        from requests.auth import HTTPBasicAuth
+        username, password = opts['auth'].split(':')
+        httpauth = HTTPBasicAuth(username, password)
+
+    if opts.get('payload'):
+        return http.post(get_url(opts), data=opts['payload'], auth=httpauth, timeout=timeout, stream=True)
+    return http.get(get_url(opts), auth=httpauth, timeout=timeout, stream=True)
+
+def check_response(opts, status_code, response_secs, matched, body):
+    """Get the value to report and the exit code of a response with given parameters."""
+
+    if opts.get('value'):
+        if opts.get('content'):
+            return body.decode('utf-8', 'replace'), 0
+        elif opts.get('timeout'):
+            return response_secs, 0
+        else:
+            return status_code, 0
+    else:
+        if status_code == 200:
+            if opts.get('content'):
+                if matched:
+                    return 0, 0
+                else:
+                    return 1, 0
+            else:
+                return 0, 0
+        else:
+            return 1, 0
+
+def get_value(opts, session=None, tls=None):
+    """Get the value to report and the exit code with given parameters.
+
+    The TLS details of the handshake are put in tls, if given, when the check runs without requests.
+    """
+
+    if session is None and not use_requests(opts):
+        return get_fast_value(opts, tls)
+
+    import requests
+
+    http = session or requests
+
+    start_timestamp = time.monotonic()
     if opts.get('timeout'):
         timeout = opts['timeout']
     else:
         timeout = 10
     try:
-        if opts.get('auth'):
-            from requests.auth import HTTPBasicAuth
-            username, password = opts['auth'].split(':')
-            httpauth = HTTPBasicAuth(username, password)
-            if opts.get('payload'):
-                payload = opts['payload']
-                req = requests.post(url, data=payload, auth=httpauth, timeout=timeout)
-            else:
-                req = requests.get(url, auth=httpauth, timeout=timeout)
-        else:
-            if opts.get('payload'):
-                payload = opts['payload']
-                req = requests.post(url, data=payload, timeout=timeout)
+        req = send_request(http, opts, timeout)
+
+        # the body is streamed, so a content check stops reading at the first match
+        with req:
+            if opts.get('content'):
+                chunks = req.iter_content(CHUNK_SIZE)
+                match_timestamp, bytes_read, body = read_content(chunks, opts['content'],
+                                                                 opts.get('max_bytes', MAX_BYTES), opts.get('value'))
+                # the shared session of a batch reuses the connection only once the whole body is read
+                if session is not None:
+                    drain_content(chunks, opts.get('max_bytes', MAX_BYTES), bytes_read)
             else:
-                req = requests.get(url, timeout=timeout)
+                # read the body, so the response time covers the transfer and the connection can be reused
+                req.content
 
-        end_timestamp = time.time()
+        end_timestamp = time.monotonic()
         response_secs = round(end_timestamp - start_timestamp, 3)
 
-        if opts.get('value'):
-            if opts.get('content'):
-                print(req.content.decode('utf-8'))
-            elif opts.get('timeout'):
-                print(response_secs)
-            else:
-                print(req.status_code)
+        return check_response(opts, req.status_code, response_secs, match_timestamp is not None if opts.get('content') else None,
+                              body if opts.get('content') else None)
+
+    except requests.exceptions.Timeout:
+        return ("Timeout" if opts.get('value') else 1), 0
+
+    except requests.exceptions.ConnectionError:
+        return ("ConnectionError" if opts.get('value') else 1), 0
+
+    except Exception as e:
+        return (f"Unexpected error: {str(e)}" if opts.get('value') else 1), 2
+
+def get_results(opts):
+    """Get results with given parameters."""
+
+    if not opts.get('tls'):
+        value, code = get_value(opts)
+        print(value)
+        return code
+
+    tls = {'cert_days': None, 'tls_version': None, 'tls_cipher': None}
+    value, code = get_value(opts, tls=tls)
+    if opts['tls'] == 'json':
+        print(json.dumps(dict(value=value, **tls)))
+    else:
+        key = f"zcurl[{opts['url']}]"
+        print(f"{zabbix_quote(opts['host'])} {zabbix_quote(key)} {zabbix_quote(value)}")
+        print_tls_info(opts['host'], opts['url'], tls)
+    return code
+
+def get_phases(opts):
+    """Time each phase of one request: DNS, TCP connect, TLS handshake, time to first byte and body transfer."""
+
+    import ssl
+    import socket
+    import http.client
+    from urllib.parse import urlsplit
+
+    parts = urlsplit(get_url(opts))
+    https = parts.scheme == 'https'
+    port = parts.port or (443 if https else 80)
+    timeout = opts.get('timeout') or 10
+
+    # requests does not expose its phases, so the connection is made step by step here,
+    # each step timed with the monotonic clock
+    phases = {'dns': None, 'connect': None, 'tls': None, 'ttfb': None, 'transfer': None, 'total': None}
+    sock = None
+    try:
+        start_timestamp = time.monotonic()
+        family, socktype, proto, _, sockaddr = socket.getaddrinfo(parts.hostname, port, type=socket.SOCK_STREAM)[0]
+        dns_timestamp = time.monotonic()
+        phases['dns'] = round(dns_timestamp - start_timestamp, 6)
+
+        sock = socket.socket(family, socktype, proto)
+        sock.settimeout(timeout)
+        sock.connect(sockaddr)
+        connect_timestamp = time.monotonic()
+        phases['connect'] = round(connect_timestamp - dns_timestamp, 6)
+
+        if https:
+            try:
+                sock = get_ssl_context().wrap_socket(sock, server_hostname=parts.hostname)
+            except ssl.SSLCertVerificationError:
+                if opts.get('tls'):
+                    add_unverified_tls_info(phases, parts.hostname, port, timeout)
+                raise
+            tls_timestamp = time.monotonic()
+            phases['tls'] = round(tls_timestamp - connect_timestamp, 6)
+            if opts.get('tls'):
+                phases.update(get_tls_info(sock))
+            conn = http.client.HTTPSConnection(parts.hostname, port, timeout=timeout)
         else:
-            if req.status_code == requests.codes.ok:
+            tls_timestamp = connect_timestamp
+            phases['tls'] = 0.0
+            conn = http.client.HTTPConnection(parts.hostname, port, timeout=timeout)
+
+        # hand the connected socket over, so http.client does not connect again
+        conn.sock = sock
+        conn.request('POST' if opts.get('payload') else 'GET', get_path(parts), body=opts.get('payload'), headers=get_headers(opts))
+        resp = conn.getresponse()
+        ttfb_timestamp = time.monotonic()
+        phases['ttfb'] = round(ttfb_timestamp - tls_timestamp, 6)
+
+        if opts.get('content'):
+            match_timestamp, bytes_read, _ = read_content(iter(lambda: resp.read(CHUNK_SIZE), b''), opts['content'],
+                                                          opts.get('max_bytes', MAX_BYTES))
+        else:
+            bytes_read = len(resp.read())
+        end_timestamp = time.monotonic()
+        phases['transfer'] = round(end_timestamp - ttfb_timestamp, 6)
+        phases['total'] = round(end_timestamp - start_timestamp, 6)
+        phases['status_code'] = resp.status
+        phases['size'] = bytes_read
+        if opts.get('content'):
+            phases['match'] = int(match_timestamp is not None)
+            phases['time_to_match'] = round(match_timestamp - start_timestamp, 6) if match_timestamp is not None else None
+        return phases, 0
+
+    except socket.timeout:
+        phases['error'] = "Timeout"
+        return phases, 0
+
+    except (OSError, http.client.HTTPException) as e:
+        phases['error'] = f"ConnectionError: {str(e)}"
+        return phases, 0
+
+    except Exception as e:
+        phases['error'] = f"Unexpected error: {str(e)}"
+        return phases, 2
+
+    finally:
+        if sock:
+            sock.close()
+
+def get_timing_results(opts):
+    """Print the time of each phase of the request as JSON or zabbix_sender lines."""
+
+    phases, code = get_phases(opts)
+    if opts['timing'] == 'json':
+        print(json.dumps(phases))
+    else:
+        tls = dict((name, phases.pop(name)) for name in ['cert_days', 'tls_version', 'tls_cipher'] if name in phases)
+        for phase, value in phases.items():
+            if value is not None:
+                key = f"zcurl.phase[{opts['url']},{phase}]"
+                print(f"{zabbix_quote(opts['host'])} {zabbix_quote(key)} {zabbix_quote(value)}")
+        print_tls_info(opts['host'], opts['url'], tls)
+    return code
+
+def percentile(values, percent):
+    """Get the nearest-rank percentile of sorted values."""
+
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * percent // 100))
+    return values[int(rank) - 1]
+
+def get_samples(opts):
+    """Send the probes of --samples over one pooled connection and summarize their latency."""
+
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    timeout = opts.get('timeout') or 10
+
+    # a pool of one connection, so every probe after the first one should reuse it
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    latencies = []
+    errors = 0
+    sockets = set()
+    closed = 0
+    for i in range(opts['samples']):
+        if i and opts['interval']:
+            time.sleep(opts['interval'] / 1000.0)
+
+        start_timestamp = time.monotonic()
+        try:
+            with send_request(session, opts, timeout) as req:
+                # a dropped connection is reconnected by the same pooled object, so count the sockets instead,
+                # a response that closes its connection has no socket left and the next probe needs a new one
+                if req.raw.connection is not None and req.raw.connection.sock is not None:
+                    sockets.add(req.raw.connection.sock)
+                else:
+                    closed += 1
                 if opts.get('content'):
-                    if opts['content'] in req.content.decode('utf-8'):
-                        print(0)
-                    else:
-                        print(1)
+                    chunks = req.iter_content(CHUNK_SIZE)
+                    match_timestamp, bytes_read, _ = read_content(chunks, opts['content'], opts.get('max_bytes', MAX_BYTES))
+                    # the rest of the body is read too, or the connection is dropped instead of reused
+                    drain_content(chunks, opts.get('max_bytes', MAX_BYTES), bytes_read)
+                    ok = req.status_code == requests.codes.ok and match_timestamp is not None
                 else:
-                    print(0)
-            else:
-                print(1)
+                    req.content
+                    ok = req.status_code == requests.codes.ok
+        except requests.exceptions.RequestException:
+            ok = False
+        end_timestamp = time.monotonic()
+
+        if ok:
+            latencies.append(end_timestamp - start_timestamp)
+        else:
+            errors += 1
+
+    connections = len(sockets) + closed
+    latencies.sort()
+    summary = {'samples': opts['samples'], 'errors': errors, 'error_rate': round(errors / opts['samples'], 6)}
+    for name, percent in [('min', 0), ('p50', 50), ('p95', 95), ('p99', 99), ('max', 100)]:
+        value = percentile(latencies, percent)
+        summary[name] = round(value, 6) if value is not None else None
+    summary['connections'] = connections
+    summary['reused'] = int(connections == 1 and opts['samples'] - errors > 1)
+
+    session.close()
+    return summary, 0
+
+def get_samples_results(opts):
+    """Print the latency summary of --samples as JSON or zabbix_sender lines."""
+
+    summary, code = get_samples(opts)
+    if opts['timing'] == 'zabbix':
+        for name, value in summary.items():
+            if value is not None:
+                key = f"zcurl.samples[{opts['url']},{name}]"
+                print(f"{zabbix_quote(opts['host'])} {zabbix_quote(key)} {zabbix_quote(value)}")
+    else:
+        print(json.dumps(summary))
+    return code
+
+def zabbix_quote(value):
+    """Quote a value for zabbix_sender input, which reads one item per line."""
+
+    value = str(value)
+    if value and not any(c in value for c in ' \t\n"\\'):
+        return value
+    value = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return f'"{value}"'
+
+def load_checks(batch):
+    """Load the checks of a batch file, one JSON object per line."""
+
+    if batch == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(batch) as f:
+            lines = f.readlines()
+
+    checks = []
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            check = json.loads(line)
+        except ValueError as e:
+            print(f"Invalid check on line {line_number} of {batch}: {str(e)}")
+            sys.exit(2)
+        if not check.get('url'):
+            print(f"Invalid check on line {line_number} of {batch}. Expected a url")
+            sys.exit(2)
+        if check.get('auth') and len(check['auth'].split(':')) != 2:
+            print(f"Invalid auth format on line {line_number} of {batch}. Expected username:password")
+            sys.exit(2)
+        checks.append(check)
+
+    return checks
+
+def get_batch_results(opts):
+    """Run the checks of a batch file concurrently and print one zabbix_sender line per check."""
+
+    from concurrent.futures import ThreadPoolExecutor
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    checks = load_checks(opts['batch'])
+
+    # one session for all checks, so keep-alive connections to the same host are reused
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=opts['workers'], pool_maxsize=opts['workers'])
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    # a pooled connection hides its handshake, so a check asking for the TLS details gets its own connection
+    def run_check(check):
+        if check.get('tls'):
+            tls = {}
+            return get_value(check, tls=tls), tls
+        return get_value(check, session), {}
+
+    with ThreadPoolExecutor(max_workers=opts['workers']) as executor:
+        results = list(executor.map(run_check, checks))
+
+    code = 0
+    for check, ((value, check_code), tls) in zip(checks, results):
+        key = check.get('key') or f"zcurl[{check['url']}]"
+        print(f"{zabbix_quote(check.get('host') or opts['host'])} {zabbix_quote(key)} {zabbix_quote(value)}")
+        print_tls_info(check.get('host') or opts['host'], check['url'], tls)
+        code = max(code, check_code)
+
+    return code
+
+def fetch_response(opts, session, max_bytes):
+    """Fetch the status code, response time and body of a check, or the error it ran into."""
+
+    import requests
+
+    timeout = opts.get('timeout') or 10
+    start_timestamp = time.monotonic()
+    try:
+        with send_request(session, opts, timeout) as req:
+            body = bytearray()
+            for chunk in req.iter_content(CHUNK_SIZE):
+                body += chunk
+                if max_bytes and len(body) >= max_bytes:
+                    break
+        end_timestamp = time.monotonic()
+        return {'status_code': req.status_code, 'response_secs': round(end_timestamp - start_timestamp, 3),
+                'body': bytes(body[:max_bytes] if max_bytes else body)}
 
     except requests.exceptions.Timeout:
-        print("Timeout" if opts.get('value') else 1)
+        return {'error': "Timeout", 'code': 0}
 
     except requests.exceptions.ConnectionError:
-        print("ConnectionError" if opts.get('value') else 1)
+        return {'error': "ConnectionError", 'code': 0}
 
     except Exception as e:
-        print(f"Unexpected error: {str(e)}" if opts.get('value') else 1)
-        return 2
+        return {'error': f"Unexpected error: {str(e)}", 'code': 2}
+
+def get_cached_value(opts, session, cache, lock, cache_ttl, max_bytes):
+    """Get the value of a check from the response cached for its url, method, payload and auth.
+
+    The first check of a key fetches the response, the identical checks arriving
+    meanwhile wait for it, and all of them reuse it until cache_ttl expires.
+    """
+
+    key = (get_url(opts), 'POST' if opts.get('payload') else 'GET', opts.get('payload') or '', opts.get('auth') or '')
+    now = time.monotonic()
+    with lock:
+        entry = cache.get(key)
+        fetch = entry is None or (entry['done'].is_set() and entry['expires'] <= now)
+        if fetch:
+            for expired in [k for k, e in cache.items() if e['done'].is_set() and e['expires'] <= now]:
+                del cache[expired]
+            entry = {'done': threading.Event(), 'response': None, 'expires': None}
+            cache[key] = entry
+
+    if fetch:
+        entry['response'] = fetch_response(opts, session, max_bytes)
+        entry['expires'] = time.monotonic() + cache_ttl
+        entry['done'].set()
+    else:
+        entry['done'].wait()
+
+    response = entry['response']
+    if 'error' in response:
+        return (response['error'] if opts.get('value') else 1), response['code']
+
+    # the response was fetched with the timeout of the first check, hold it to this one's own
+    if response['response_secs'] > (opts.get('timeout') or 10):
+        return ("Timeout" if opts.get('value') else 1), 0
+
+    body = response['body']
+    if opts.get('max_bytes'):
+        body = body[:opts['max_bytes']]
+    matched = opts['content'].encode('utf-8') in body if opts.get('content') else None
+    return check_response(opts, response['status_code'], response['response_secs'], matched, body)
+
+def run_daemon(opts):
+    """Answer checks on a unix socket, one JSON request and reply line per connection."""
+
+    import os
+    import stat
+    import signal
+    import socket
+    import socketserver
+    import requests
+    from requests.adapters import HTTPAdapter
 
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=opts['workers'], pool_maxsize=opts['workers'])
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    cache = {}
+    lock = threading.Lock()
+
+    class CheckHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            line = self.rfile.readline()
+            if not line:
+                # a connection that only checks the daemon is up
+                return
+            try:
+                check = json.loads(line)
+                value, code = get_cached_value(check, session, cache, lock, opts['cache_ttl'], opts['max_bytes'])
+            except (ValueError, KeyError, TypeError) as e:
+                value, code = f"Unexpected error: {str(e)}", 2
+            self.wfile.write((json.dumps({'value': value, 'code': code}) + '\n').encode('utf-8'))
+
+    # a socket left behind by a daemon that was killed would fail the bind
+    if os.path.lexists(opts['daemon']):
+        if not stat.S_ISSOCK(os.lstat(opts['daemon']).st_mode):
+            print(f"Invalid daemon socket. {opts['daemon']} exists and is not a socket")
+            return 2
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(opts['daemon'])
+            print(f"Invalid daemon socket. A daemon is already running on {opts['daemon']}")
+            return 2
+        except OSError:
+            os.remove(opts['daemon'])
+        finally:
+            probe.close()
+    server = socketserver.ThreadingUnixStreamServer(opts['daemon'], CheckHandler)
+    server.daemon_threads = True
+    sock_stat = os.lstat(opts['daemon'])
+
+    def stop(signum, frame):
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        # only our own socket, another daemon may have replaced it
+        try:
+            if os.path.samestat(os.lstat(opts['daemon']), sock_stat):
+                os.remove(opts['daemon'])
+        except OSError:
+            pass
     return 0
 
+def get_daemon_results(opts):
+    """Send the check to the daemon and print its value, or run it here if the daemon is down."""
+
+    import socket
+
+    check = dict((k, opts[k]) for k in ['url', 'timeout', 'content', 'max_bytes', 'auth', 'value', 'payload'])
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout((opts['timeout'] or 10) + 5)
+        sock.connect(opts['socket'])
+        with sock, sock.makefile('rwb') as f:
+            f.write((json.dumps(check) + '\n').encode('utf-8'))
+            f.flush()
+            reply = json.loads(f.readline())
+    except (OSError, ValueError):
+        return get_results(opts)
+
+    print(reply['value'])
+    return reply['code']
+
 def main():
     opts = parse_opts()
+    if opts['daemon']:
+        return run_daemon(opts)
+    if opts['batch']:
+        return get_batch_results(opts)
+    if opts['samples']:
+        return get_samples_results(opts)
+    if opts['timing']:
+        return get_timing_results(opts)
+    if opts['socket'] and not opts['tls']:
+        return get_daemon_results(opts)
     return get_results(opts)
 
 if __name__ == '__main__':
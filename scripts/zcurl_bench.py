@@ -0,0 +1,111 @@
+# Description: Startup time benchmark of zcurl.py, the http.client path against the requests path
+# Author: Dong Guo
+
+import os
+import sys
+import json
+import time
+import argparse
+import textwrap
+import threading
+import subprocess
+import http.server
+
+ZCURL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'zcurl.py')
+
+def parse_opts():
+    """Help messages(-h, --help)."""
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent(
+        '''
+        examples:
+          {0}
+          {0} -r 50
+          {0} -r 50 -s zcurl_bench.json
+        '''.format(__file__)
+        ))
+
+    parser.add_argument('-r', metavar='runs', type=int, default=20, help='runs of each case [default: 20]')
+    parser.add_argument('-s', metavar='save', type=str, help='save the results as JSON to this file')
+
+    args = parser.parse_args()
+
+    if args.r < 1:
+        print("Invalid runs. Expected a positive number")
+        sys.exit(2)
+
+    return {'runs': args.r, 'save': args.s}
+
+class HealthHandler(http.server.BaseHTTPRequestHandler):
+    """A local health endpoint, so the network does not hide the startup time."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'ok'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def time_command(command, runs):
+    """Run a command the given times and return the wall time of each run."""
+
+    env = dict(os.environ)
+    # a proxy in the environment would send the fast path to requests as well
+    for name in ['http_proxy', 'https_proxy', 'all_proxy', 'HTTP_PROXY', 'HTTPS_PROXY', 'ALL_PROXY']:
+        env.pop(name, None)
+
+    latencies = []
+    for i in range(runs):
+        start_timestamp = time.monotonic()
+        output = subprocess.run(command, env=env, stdout=subprocess.PIPE, check=True).stdout.decode('utf-8').strip()
+        latencies.append(time.monotonic() - start_timestamp)
+        if output != '0':
+            print(f"ERROR: {' '.join(command)} returned {output}")
+            sys.exit(1)
+    return latencies
+
+def main():
+    opts = parse_opts()
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), HealthHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/health"
+
+    cases = [
+        ('python startup', [sys.executable, '-c', 'print(0)']),
+        ('import requests', [sys.executable, '-c', 'import requests; print(0)']),
+        ('zcurl http.client', [sys.executable, ZCURL, '-u', url, '-c', 'ok']),
+        ('zcurl requests', [sys.executable, ZCURL, '-u', url, '-c', 'ok', '-R']),
+    ]
+
+    results = []
+    try:
+        for name, command in cases:
+            latencies = sorted(time_command(command, opts['runs']))
+            result = {'name': name, 'runs': opts['runs'], 'min': latencies[0], 'p50': latencies[len(latencies) // 2],
+                      'max': latencies[-1]}
+            results.append(result)
+            print(f"  {name:<20} min {result['min'] * 1000:7.1f}ms  p50 {result['p50'] * 1000:7.1f}ms  max {result['max'] * 1000:7.1f}ms")
+    finally:
+        server.shutdown()
+
+    fast, slow = results[2]['p50'], results[3]['p50']
+    print(f"http.client path saves {(slow - fast) * 1000:.1f}ms per check at p50, {(1 - fast / slow) * 100:.0f}% of the requests path")
+
+    if opts['save']:
+        data = {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': sys.version.split()[0], 'results': results}
+        with open(opts['save'], 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        print(f"Saved results to {opts['save']}")
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())